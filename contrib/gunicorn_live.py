@@ -0,0 +1,22 @@
+# gunicorn settings for serving the /api/live stats stream. every open page
+# holds a stream, so it needs async workers (pip install gevent) rather than
+# the sync workers the rest of the site runs on, where a handful of open
+# tabs would tie up every worker. run it next to the main site with
+#
+#   gunicorn -c contrib/gunicorn_live.py simplecoin.wsgi_entry:app
+#
+# and route /api/live to it from the frontend proxy, with buffering off:
+#
+#   location /api/live {
+#       proxy_pass http://127.0.0.1:9401;
+#       proxy_buffering off;
+#       proxy_read_timeout 1h;
+#   }
+#
+# the stream only waits on redis, which gevent's patching makes cooperative.
+# the database calls the other views make would block a whole worker, so
+# keep the rest of the site on sync workers
+bind = '127.0.0.1:9401'
+worker_class = 'gevent'
+workers = 2
+worker_connections = 1000
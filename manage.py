@@ -1,6 +1,9 @@
 import os
+import sys
+import json
 import logging
 import datetime
+import subprocess
 import sqlalchemy
 
 from flask.ext.script import Manager, Shell
@@ -14,9 +17,9 @@ migrate = Migrate(app, db)
 root = os.path.abspath(os.path.dirname(__file__) + '/../')
 
 from bitcoinrpc.authproxy import AuthServiceProxy
-from simplecoin.tasks import (cleanup, payout, server_status,
-                              update_online_workers, update_pplns_est,
-                              cache_user_donation)
+from simplecoin.tasks import (cleanup, payout, update_online_workers,
+                              update_pplns_est, cache_user_donation,
+                              update_worker_stats)
 from simplecoin.models import (Transaction, Threshold, DonationPercent,
                                BonusPayout, OneMinuteType, FiveMinuteType,
                                Block, MergeAddress, Payout)
@@ -145,8 +148,8 @@ def reload_cached():
     Good to run if celery has been down, site just setup, etc. """
     update_pplns_est()
     update_online_workers()
+    update_worker_stats()
     cache_user_donation()
-    server_status()
 
 
 @manager.command
@@ -196,6 +199,39 @@ def payout_cmd(simulate):
     payout(simulate=simulate)
 
 
+# run in a fresh interpreter so nothing is already imported. the heavy
+# dependencies are imported first so the simplecoin times are its own
+PROFILE_STARTUP = """
+import json, time
+times = []
+for mod in ['yaml', 'redis', 'sqlalchemy', 'flask', 'flask.ext.sqlalchemy',
+            'flask.ext.cache', 'celery', 'bitcoinrpc', 'cryptokit', 'simplecoin']:
+    start = time.time()
+    __import__(mod)
+    times.append(('import ' + mod, time.time() - start))
+from simplecoin import {factory}
+start = time.time()
+app = {factory}()
+times.append(('{factory} total', time.time() - start))
+print json.dumps(times + [('{factory} ' + stage, secs)
+                          for stage, secs in app.startup_times])
+"""
+
+
+@manager.option('-w', '--worker', action='store_true', default=False,
+                help='Profile the celery worker app instead of the web app')
+def profile_startup(worker=False):
+    """ Reports the time a new process spends importing each component and
+    in each stage of app creation """
+    script = PROFILE_STARTUP.format(
+        factory='create_worker_app' if worker else 'create_app')
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    # anything logged during startup comes before the times
+    for stage, secs in json.loads(output.strip().splitlines()[-1]):
+        print "{:<40}{:>10.1f} ms".format(stage, secs * 1000)
+
+
 def make_context():
     """ Setup a coinserver connection fot the shell context """
     app = _request_ctx_stack.top.app
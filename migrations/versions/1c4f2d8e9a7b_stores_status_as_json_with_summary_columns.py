@@ -0,0 +1,56 @@
+"""Stores status as json with summary columns derived from it
+
+Revision ID: 1c4f2d8e9a7b
+Revises: 4a1ba5b8b3c2
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c4f2d8e9a7b'
+down_revision = '4a1ba5b8b3c2'
+
+import json
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.execute('ALTER TABLE status ALTER COLUMN status TYPE json USING status::json')
+    op.add_column('status', sa.Column('total_mhs', sa.Float(), nullable=True))
+    op.add_column('status', sa.Column('wu', sa.Float(), nullable=True))
+    op.add_column('status', sa.Column('version', postgresql.ARRAY(sa.Integer()), nullable=True))
+
+    # fill in the summaries for statuses already stored, the same way
+    # Status.derive does for new ones
+    conn = op.get_bind()
+    for user, worker, status in conn.execute('SELECT "user", worker, status FROM status').fetchall():
+        if isinstance(status, basestring):
+            status = json.loads(status)
+        gpus = status.get('gpus', [])
+        try:
+            total_mhs = sum([gpu['MHS av'] for gpu in gpus])
+        except KeyError:
+            total_mhs = 0
+        try:
+            wu = sum([(gpu['Difficulty Accepted'] / gpu['Device Elapsed']) * 60
+                      for gpu in gpus])
+        except (KeyError, ZeroDivisionError):
+            wu = 0
+        try:
+            version = [int(part) for part in status.get('v', '0.2.0').split('.')]
+        except ValueError:
+            version = None
+        conn.execute(sa.text('UPDATE status SET total_mhs = :total_mhs, wu = :wu, '
+                             'version = :version WHERE "user" = :user AND worker = :worker'),
+                     total_mhs=total_mhs, wu=wu, version=version, user=user,
+                     worker=worker)
+
+
+def downgrade():
+    op.drop_column('status', 'version')
+    op.drop_column('status', 'wu')
+    op.drop_column('status', 'total_mhs')
+    op.execute('ALTER TABLE status ALTER COLUMN status TYPE varchar USING status::text')
@@ -0,0 +1,28 @@
+"""Drops the event table, email rate limiting is now kept in redis
+
+Revision ID: 4a1ba5b8b3c2
+Revises: 53dcf1daebec
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4a1ba5b8b3c2'
+down_revision = '53dcf1daebec'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.drop_table('event')
+
+
+def downgrade():
+    op.create_table('event',
+                    sa.Column('time', sa.DateTime(), nullable=False),
+                    sa.Column('user', sa.String(), nullable=False),
+                    sa.Column('worker', sa.String(), nullable=False),
+                    sa.Column('address', sa.String(), nullable=False),
+                    sa.PrimaryKeyConstraint('time', 'user', 'worker', 'address')
+                    )
@@ -1,27 +1,155 @@
 from datetime import datetime
+from functools import partial
 import subprocess
 import logging
+import time
 import os
 
 from math import log10, floor
-from flask import Flask, current_app
-from flask.ext.sqlalchemy import SQLAlchemy
+from flask import Flask, current_app, g, has_app_context
+from flask.ext.sqlalchemy import SQLAlchemy, _SignallingSession
+from sqlalchemy import orm
 from jinja2 import FileSystemLoader
 
 from werkzeug.local import LocalProxy
+from sqlalchemy import event, exc
+import redis
 import yaml
 
 from flask.ext.cache import Cache
 from bitcoinrpc import AuthServiceProxy
 
 
+class RoutingSession(_SignallingSession):
+    """ Sends queries made with replica reads switched on to the replica
+    database, so long as it isn't lagging too far behind. Flushes, and
+    everything else, stay on the primary. """
+    def get_bind(self, mapper, clause=None):
+        if (not self._flushing and has_app_context() and
+                getattr(g, 'use_replica', False) and replica_current(self.app)):
+            return db.get_engine(self.app, bind='replica')
+        return _SignallingSession.get_bind(self, mapper, clause)
+
+
+# per process, so the lag check only runs every replica_check_interval
+replica_state = {'checked': 0, 'current': False}
+
+
+def replica_current(app):
+    """ Whether a replica is configured and has replayed the primary's
+    transactions within replica_max_lag seconds """
+    if 'replica' not in (app.config.get('SQLALCHEMY_BINDS') or {}):
+        return False
+    if time.time() - replica_state['checked'] < app.config.get('replica_check_interval', 10):
+        return replica_state['current']
+
+    replica_state['checked'] = time.time()
+    try:
+        # NULL when the server isn't in recovery, and so can't be behind
+        lag = db.get_engine(app, bind='replica').execute(
+            "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+        ).scalar() or 0
+    except Exception:
+        app.logger.warn("Unable to check replica lag, reading from primary",
+                        exc_info=True)
+        replica_state['current'] = False
+    else:
+        replica_state['current'] = lag <= app.config.get('replica_max_lag', 30)
+        if not replica_state['current']:
+            app.logger.warn("Replica is {} seconds behind, reading from primary"
+                            .format(lag))
+    return replica_state['current']
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ Applies the db_pool section of the config to the engine's pool and
+    hands out sessions that can route reads to a replica """
+    def apply_driver_hacks(self, app, info, options):
+        super(RoutingSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        pool_cfg = app.config.get('db_pool', {})
+        for key in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle'):
+            if key in pool_cfg:
+                options[key] = pool_cfg[key]
+
+    def create_scoped_session(self, options=None):
+        options = options or {}
+        scopefunc = options.pop('scopefunc', None)
+        return orm.scoped_session(partial(RoutingSession, self, **options),
+                                  scopefunc=scopefunc)
+
+
+def ping_connection(dbapi_conn, conn_record, conn_proxy):
+    """ Tests connections as they're checked out so that one the server has
+    dropped is replaced instead of failing whatever was about to use it """
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except Exception:
+        raise exc.DisconnectionError()
+    finally:
+        cursor.close()
+
+
+def rpc_url(cfg):
+    """ The URL, credentials included, of the coinserver described by a
+    coinserv config section """
+    return "http://{0}:{1}@{2}:{3}/".format(
+        cfg['username'], cfg['password'], cfg['address'], cfg['port'])
+
+
+def rpc_proxy(cfg):
+    """ An AuthServiceProxy for the coinserver described by a coinserv config
+    section """
+    return AuthServiceProxy(rpc_url(cfg))
+
+
+def get_coinserv():
+    """ The main coinserver connection, made the first time it's used rather
+    than when the app starts """
+    app = current_app._get_current_object()
+    if getattr(app, 'rpc_connection', None) is None:
+        app.rpc_connection = rpc_proxy(app.config['coinserv'])
+    return app.rpc_connection
+
+
+def get_merge_coinserv():
+    """ Connections to each enabled merged coinserver keyed by currency name,
+    made the first time any of them is used """
+    app = current_app._get_current_object()
+    if getattr(app, 'merge_rpc_connection', None) is None:
+        app.merge_rpc_connection = {cfg['currency_name']: rpc_proxy(cfg['coinserv'])
+                                    for cfg in app.config['merge'] if cfg['enabled']}
+    return app.merge_rpc_connection
+
+
+_revision = None
+
+
+def git_revision():
+    """ The (hash, date) of the running code. Read from a REVISION file in the
+    repository root written at deploy time with `git show -s --format='%ci %h'
+    > REVISION`, falling back to asking git the first time it's needed. """
+    global _revision
+    if _revision is None:
+        try:
+            path = os.path.join(root, 'REVISION')
+            if os.path.exists(path):
+                output = open(path).read()
+            else:
+                output = subprocess.check_output(
+                    "git show -s --format='%ci %h'", shell=True, cwd=root)
+            date, commit = output.strip().rsplit(" ", 1)
+            _revision = dict(hash=commit, date=date)
+        except Exception:
+            _revision = dict(hash='', date='')
+    return _revision
+
+
 root = os.path.abspath(os.path.dirname(__file__) + '/../')
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 cache = Cache()
-coinserv = LocalProxy(
-    lambda: getattr(current_app, 'rpc_connection', None))
-merge_coinserv = LocalProxy(
-    lambda: getattr(current_app, 'merge_rpc_connection', None))
+coinserv = LocalProxy(get_coinserv)
+merge_coinserv = LocalProxy(get_merge_coinserv)
 
 
 def sig_round(x, sig=2):
@@ -30,71 +158,100 @@ def sig_round(x, sig=2):
     return "{:,f}".format(round(x, sig - int(floor(log10(abs(x)))) - 1)).rstrip('0').rstrip('.')
 
 
-def create_app(config='/config.yml', celery=False):
+def mark_startup(app, stage):
+    """ Records the seconds spent on a stage of startup since the last one
+    finished, reported by `manage.py profile_startup` """
+    now = time.time()
+    app.startup_times.append((stage, now - app.startup_mark))
+    app.startup_mark = now
+
+
+def load_app(config):
+    """ Loads the config and sets up the database and cache, which is all
+    the web app and the task workers have in common. Coinserver connections
+    are made when first used. """
+    start = time.time()
     # initialize our flask application
     app = Flask(__name__, static_folder='../static', static_url_path='/static')
+    app.startup_times = []
+    app.startup_mark = start
 
-    # set our template path and configs
-    app.jinja_loader = FileSystemLoader(os.path.join(root, 'templates'))
     config_vars = yaml.load(open(root + config))
     # inject all the yaml configs
     app.config.update(config_vars)
-    app.logger.info(app.config)
-
-    app.rpc_connection = AuthServiceProxy(
-        "http://{0}:{1}@{2}:{3}/"
-        .format(app.config['coinserv']['username'],
-                app.config['coinserv']['password'],
-                app.config['coinserv']['address'],
-                app.config['coinserv']['port'],
-                pool_kwargs=dict(maxsize=app.config.get('maxsize', 10))))
-
-    app.merge_rpc_connection = {}
-    for cfg in app.config['merge']:
-        if not cfg['enabled']:
-            continue
-        app.merge_rpc_connection[cfg['currency_name']] = AuthServiceProxy(
-            "http://{0}:{1}@{2}:{3}/"
-            .format(cfg['coinserv']['username'],
-                    cfg['coinserv']['password'],
-                    cfg['coinserv']['address'],
-                    cfg['coinserv']['port'],
-                    pool_kwargs=dict(maxsize=app.config.get('maxsize', 10))))
-
-    # add the debug toolbar if we're in debug mode...
-    if app.config['DEBUG']:
-        from flask_debugtoolbar import DebugToolbarExtension
-        DebugToolbarExtension(app)
-        app.logger.handlers[0].setFormatter(logging.Formatter(
-            '%(asctime)s %(levelname)s: %(message)s '
-            '[in %(filename)s:%(lineno)d]'))
+    app.logger.debug("Loaded config from {}".format(root + config))
 
     # map all our merged coins into something indexed by type for convenience
     app.config['merged_cfg'] = {cfg['currency_name']: cfg for cfg in app.config['merge']}
+    mark_startup(app, 'config')
 
     # register all our plugins
     db.init_app(app)
+    engine = db.get_engine(app)
+    if app.config.get('db_pool', {}).get('pre_ping'):
+        event.listen(engine, 'checkout', ping_connection)
+    from .utils import watch_pool
+    watch_pool(engine)
+    mark_startup(app, 'database')
+
     cache_config = {'CACHE_TYPE': 'redis'}
     cache_config.update(app.config.get('main_cache', {}))
+    redis_pool = app.config.get('redis_pool')
+    if redis_pool:
+        # a client object passed as the host is used by the cache as is
+        cache_config['CACHE_REDIS_HOST'] = redis.Redis(
+            connection_pool=redis.BlockingConnectionPool(
+                host=cache_config.get('CACHE_REDIS_HOST', 'localhost'),
+                port=cache_config.get('CACHE_REDIS_PORT', 6379),
+                password=cache_config.get('CACHE_REDIS_PASSWORD'),
+                db=cache_config.get('CACHE_REDIS_DB', 0),
+                max_connections=redis_pool.get('max_connections', 50),
+                timeout=redis_pool.get('timeout', 20)))
     cache.init_app(app, config=cache_config)
+    mark_startup(app, 'cache')
+
+    return app
 
-    if not celery:
-        hdlr = logging.FileHandler(app.config.get('log_file', 'webserver.log'))
-        formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-        hdlr.setFormatter(formatter)
-        app.logger.addHandler(hdlr)
-        app.logger.setLevel(logging.INFO)
 
-        # try and fetch the git version information
-        try:
-            output = subprocess.check_output("git show -s --format='%ci %h'",
-                                             shell=True).strip().rsplit(" ", 1)
-            app.config['hash'] = output[1]
-            app.config['revdate'] = output[0]
-        # celery won't work with this, so set some default
-        except Exception:
-            app.config['hash'] = ''
-            app.config['revdate'] = ''
+def create_worker_app(config='/config.yml'):
+    """ The app for celery workers. Only the task modules are loaded on top
+    of the database and cache, leaving out the blueprints, templates and the
+    API's dependencies that no task uses. """
+    app = load_app(config)
+
+    from .tasks import celery
+    celery.conf.update(app.config)
+    mark_startup(app, 'tasks')
+
+    return app
+
+
+def create_app(config='/config.yml'):
+    app = load_app(config)
+
+    # set our template path
+    app.jinja_loader = FileSystemLoader(os.path.join(root, 'templates'))
+
+    # add the debug toolbar if we're in debug mode...
+    if app.config['DEBUG']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+        app.logger.handlers[0].setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s '
+            '[in %(filename)s:%(lineno)d]'))
+    mark_startup(app, 'debug toolbar')
+
+    hdlr = logging.FileHandler(app.config.get('log_file', 'webserver.log'))
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+    hdlr.setFormatter(formatter)
+    app.logger.addHandler(hdlr)
+    app.logger.setLevel(logging.INFO)
+    mark_startup(app, 'logging')
+
+    # the revision is only looked up when a page first shows it
+    @app.context_processor
+    def inject_revision():
+        return dict(revision=git_revision())
 
     # filters for jinja
     @app.template_filter('fader')
@@ -155,13 +312,17 @@ def create_app(config='/config.yml', celery=False):
             return str(day_diff/30) + " months ago"
         return str(day_diff/365) + " years ago"
 
+    mark_startup(app, 'jinja')
+
     from .tasks import celery
     celery.conf.update(app.config)
+    mark_startup(app, 'tasks')
 
     # Route registration
     # =========================================================================
     from . import views, models, api, rpc_views
     app.register_blueprint(views.main)
     app.register_blueprint(api.api, url_prefix='/api')
+    mark_startup(app, 'blueprints')
 
     return app
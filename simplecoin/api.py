@@ -1,8 +1,12 @@
 from pprint import pformat
+import json
 import sys
 
-from flask import Blueprint, current_app, jsonify
-from lever import (API, LeverException)
+from flask import Blueprint, current_app, jsonify, request, g
+from lever import (API, LeverException, LeverSyntaxError, postprocess,
+                   preprocess, jsonize)
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.sql import tuple_
 import six
 
 from .models import (Block, Share, Transaction, Payout, OneMinuteShare, Status,
@@ -56,6 +60,95 @@ def api_error_handler(exc):
 class APIBase(API):
     session = db.session
     create_method = 'create'
+    # columns that uniquely order the model newest first. If set, results are
+    # keyset paginated with the `__before` parameter instead of offsets
+    keyset = None
+
+    @preprocess(method='get', pri=0)
+    def limit_request(self):
+        """ Applies the configured row cap and a statement timeout so a broad
+        query can't tie up the database, and sends the reads to the replica """
+        g.use_replica = True
+        self.max_pg_size = min(self.max_pg_size,
+                               current_app.config.get('api_max_pg_size', 100))
+        timeout = current_app.config.get('api_statement_timeout', 5000)
+        if timeout:
+            # local to the transaction, which ends with the request
+            self.session.execute("SET LOCAL statement_timeout = {}"
+                                 .format(int(timeout)))
+
+    def get(self):
+        if not request.args.get('fields'):
+            return API.get(self)
+        return self.get_fields()
+
+    def get_fields(self):
+        """ Like a regular search, but selects only the comma separated
+        column names passed as `fields` and returns them without running
+        the join profile. """
+        self.params = dict((k, v) for k, v in six.iteritems(request.args))
+        fields = self.params.pop('fields').split(',')
+        columns = set(c.key for c in class_mapper(self.model).columns)
+        invalid = [f for f in fields if f not in columns]
+        if invalid:
+            raise LeverSyntaxError("Invalid fields requested: {}"
+                                   .format(", ".join(invalid)))
+        for method in self._pre_method.get('get', []):
+            method(self)
+
+        query = self.session.query(*[getattr(self.model, f) for f in fields])
+        query = self.paginate(query=self.search(query=query))
+        retval = dict(success=True,
+                      objects=[jsonize(row, fields, raw=True) for row in query])
+        for method in self._post_method.get('get', []):
+            method(self, retval)
+        return jsonify(**retval)
+
+    def search(self, query=None):
+        # an explicit ordering from the client takes precedence over keyset
+        # pagination
+        self.keyset_order = (self.keyset is not None and
+                             '__order_by' not in self.params)
+        return API.search(self, query=query)
+
+    def paginate(self, query=None):
+        """ Pages through the results with a `__before` cursor, a JSON list
+        of the `keyset` values of the last object from the previous page.
+        Falls back to lever's offset pagination when ordered by the
+        client. """
+        before = self.params.pop('__before', None)
+        if not self.keyset_order:
+            return API.paginate(self, query=query)
+
+        if query is None:
+            query = self.session.query(self.model)
+        cols = [getattr(self.model, col) for col in self.keyset]
+        if before is not None:
+            try:
+                before = json.loads(before)
+                assert isinstance(before, list) and len(before) == len(cols)
+            except (ValueError, AssertionError):
+                raise LeverSyntaxError(
+                    "__before must be a JSON list of values for {}"
+                    .format(", ".join(self.keyset)))
+            query = query.filter(tuple_(*cols) < tuple_(*before))
+
+        try:
+            pg_size = min(int(self.params.get('pg_size', self.max_pg_size)),
+                          self.max_pg_size)
+        except ValueError:
+            pg_size = self.max_pg_size
+        return query.order_by(*[col.desc() for col in cols]).limit(pg_size)
+
+    @postprocess(method='get')
+    def add_cursor(self, retval):
+        """ Lets the client know what to pass as `__before` for the next
+        page """
+        if getattr(self, 'keyset_order', False) and retval['objects']:
+            last = retval['objects'][-1]
+            # a field projection may have left out the keyset
+            if all(col in last for col in self.keyset):
+                retval['before'] = [last[col] for col in self.keyset]
 
     @classmethod
     def register(cls, mod, url):
@@ -66,10 +159,12 @@ class APIBase(API):
 
 class BlockAPI(APIBase):
     model = Block
+    keyset = ('height', 'hash')
 
 
 class PayoutAPI(APIBase):
     model = Payout
+    keyset = ('id', )
 
 
 class OneMinuteShareAPI(APIBase):
@@ -78,6 +173,7 @@ class OneMinuteShareAPI(APIBase):
 
 class ShareAPI(APIBase):
     model = Share
+    keyset = ('id', )
 
 
 class TransactionAPI(APIBase):
@@ -94,6 +190,7 @@ class BlobAPI(APIBase):
 
 class BonusPayoutAPI(APIBase):
     model = BonusPayout
+    keyset = ('id', )
 
 
 BlobAPI.register(api, '/blob')
@@ -1,11 +1,11 @@
 from flask import current_app
 
-from simplecoin import create_app
+from simplecoin import create_worker_app
 from simplecoin.tasks import celery
 from celery.bin.worker import main
 
 
-app = create_app(celery=True)
+app = create_worker_app()
 
 with app.app_context():
     # import celerybeat settings
@@ -15,9 +15,9 @@ caching_tasks = {
         'task': 'simplecoin.tasks.update_online_workers',
         'schedule': timedelta(minutes=2)
     },
-    'server_status': {
-        'task': 'simplecoin.tasks.server_status',
-        'schedule': timedelta(minutes=2),
+    'update_worker_stats': {
+        'task': 'simplecoin.tasks.update_worker_stats',
+        'schedule': timedelta(minutes=2)
     },
     'update_network': {
         'task': 'simplecoin.tasks.update_network',
@@ -56,6 +56,15 @@ database_tasks = {
     },
 }
 
+# alert emails get a queue of their own so a slow mail server can't back up
+# telemetry ingestion. run a second worker for it with
+# `python celery_entry.py -Q email`
+CELERY_ROUTES = {
+    'simplecoin.tasks.send_alert_digest': {
+        'queue': current_app.config.get('email_queue', 'email')
+    },
+}
+
 CELERYBEAT_SCHEDULE = caching_tasks
 # we want to let celery run in staging mode where it only handles updating
 # caches while the prod celery runner is handling real work. Allows separate
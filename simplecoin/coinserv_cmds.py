@@ -1,6 +1,83 @@
+import json
+import decimal
+
+import requests
+from requests.adapters import HTTPAdapter
 from flask import current_app
+from bitcoinrpc.authproxy import JSONRPCException
+
+from . import coinserv, merge_coinserv, rpc_url
+
+
+class BatchCallError(Exception):
+    """ The coinserver's answer to a batch couldn't be matched up with the
+    calls in it """
+    pass
+
+
+def coinserv_cfg(merged=None):
+    if merged:
+        return current_app.config['merged_cfg'][merged]['coinserv']
+    return current_app.config['coinserv']
+
+
+def batch_session():
+    """ The HTTP session batch calls are sent with. Kept on the app like the
+    coinserver proxies so its connections are pooled between calls, up to
+    the same maxsize. """
+    app = current_app._get_current_object()
+    if getattr(app, 'rpc_batch_session', None) is None:
+        session = requests.Session()
+        session.mount('http://', HTTPAdapter(
+            pool_maxsize=app.config.get('maxsize', 10)))
+        app.rpc_batch_session = session
+    return app.rpc_batch_session
+
+
+def batch_call(calls, merged=None, batch_size=100, timeout=30):
+    """ Sends a list of (method, params) pairs to the coinserver as JSON-RPC
+    batch requests of up to batch_size calls each, at the same URL and with
+    the same credentials as its AuthServiceProxy. Results are returned in
+    the order of calls, with failed calls given as JSONRPCException instances
+    rather than raising. A batch that isn't answered call for call raises
+    BatchCallError. """
+    # the proxy's own transport is private, so the batch is posted directly
+    url = rpc_url(coinserv_cfg(merged))
+    results = []
+    for i in xrange(0, len(calls), batch_size):
+        chunk = calls[i:i + batch_size]
+        payload = [{'version': '1.1', 'method': method, 'params': list(params),
+                    'id': j} for j, (method, params) in enumerate(chunk)]
+        ret = batch_session().post(url, data=json.dumps(payload), timeout=timeout)
+        # a daemon that rejects the whole batch can answer with one error
+        # object, and a non 200 status, instead of a list
+        try:
+            responses = ret.json(parse_float=decimal.Decimal)
+        except ValueError:
+            ret.raise_for_status()
+            raise
+        if not isinstance(responses, list):
+            raise BatchCallError(
+                "Coinserver answered a batch of {} calls with {}: {}"
+                .format(len(chunk), ret.status_code, responses))
+
+        by_id = {}
+        for resp in responses:
+            if isinstance(resp, dict) and 'id' in resp:
+                by_id[resp['id']] = resp
+        missing = [j for j in xrange(len(chunk)) if j not in by_id]
+        if missing:
+            raise BatchCallError(
+                "Coinserver answer to a batch of {} calls was missing {}, "
+                "first {}".format(len(chunk), len(missing), chunk[missing[0]]))
 
-from . import coinserv, merge_coinserv
+        for j in xrange(len(chunk)):
+            resp = by_id[j]
+            if resp.get('error'):
+                results.append(JSONRPCException(resp['error']))
+            else:
+                results.append(resp['result'])
+    return results
 
 
 def payout_many(recip, merged=None):
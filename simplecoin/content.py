@@ -0,0 +1,52 @@
+import os
+import threading
+
+import yaml
+
+from . import root
+
+
+# use the libyaml bindings when they're available, they're many times faster
+# than the pure python loader
+Loader = getattr(yaml, 'CLoader', yaml.Loader)
+
+
+class YAMLContent(object):
+    """ A YAML file of site content that is parsed once and kept in memory.
+    The file is only re-parsed when its modification time changes, so edits
+    show up without a restart. Values derived from the content (such as
+    rendered HTML) can be stored alongside it with `derived` and are thrown
+    away on reload. """
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._data = None
+        self._derived = {}
+        self._lock = threading.Lock()
+
+    def load_version(self):
+        """ Returns the content along with the dictionary of values derived
+        from that same version of it, read together under the lock so a
+        reload in another thread can't pair them up wrong. """
+        mtime = os.stat(self.path).st_mtime
+        with self._lock:
+            if mtime != self._mtime:
+                with open(self.path) as f:
+                    self._data = yaml.load(f, Loader=Loader)
+                self._derived = {}
+                self._mtime = mtime
+            return self._data, self._derived
+
+    def load(self):
+        return self.load_version()[0]
+
+    def derived(self, key, func):
+        """ Returns func(content), computing it only once for each version of
+        the file. """
+        data, derived = self.load_version()
+        if key not in derived:
+            derived[key] = func(data)
+        return derived[key]
+
+news = YAMLContent(os.path.join(root, 'static/yaml/news.yaml'))
+alerts = YAMLContent(os.path.join(root, 'static/yaml/alerts.yaml'))
@@ -1,8 +1,6 @@
 import calendar
 import logging
 import json
-import smtplib
-from email.mime.text import MIMEText
 from collections import namedtuple
 
 from datetime import datetime, timedelta
@@ -10,7 +8,7 @@ from datetime import datetime, timedelta
 from flask import current_app
 from sqlalchemy.schema import CheckConstraint
 from sqlalchemy.ext.declarative import AbstractConcreteBase, declared_attr
-from sqlalchemy.dialects.postgresql import HSTORE, ARRAY
+from sqlalchemy.dialects.postgresql import HSTORE, ARRAY, JSON
 
 from cryptokit import bits_to_difficulty
 from .model_lib import base
@@ -168,15 +166,46 @@ class Status(base):
     round """
     user = db.Column(db.String, primary_key=True)
     worker = db.Column(db.String, primary_key=True)
-    status = db.Column(db.String)
+    status = db.Column(JSON)
     time = db.Column(db.DateTime)
+    # summaries of the status, worked out once when it's received so pages
+    # don't have to walk every gpu
+    total_mhs = db.Column(db.Float)
+    wu = db.Column(db.Float)
+    version = db.Column(ARRAY(db.Integer))
+
+    @classmethod
+    def derive(cls, status):
+        """ Computes the summary columns for a status payload """
+        gpus = status.get('gpus', [])
+        try:
+            total_mhs = sum([gpu['MHS av'] for gpu in gpus])
+        except KeyError:
+            total_mhs = 0
+        try:
+            wu = sum([(gpu['Difficulty Accepted'] / gpu['Device Elapsed']) * 60
+                      for gpu in gpus])
+        except (KeyError, ZeroDivisionError):
+            wu = 0
+        try:
+            version = [int(part) for part in status.get('v', '0.2.0').split('.')]
+        except ValueError:
+            version = None
+        return dict(total_mhs=total_mhs, wu=wu, version=version)
 
     @property
     def parsed_status(self):
-        return json.loads(self.status)
+        return self.status
+
+    @property
+    def wue(self):
+        try:
+            return (self.wu or 0) / ((self.total_mhs or 0) * 1000)
+        except ZeroDivisionError:
+            return 0.0
 
     def pretty_json(self, gpu=0):
-        return json.dumps(json.loads(self.status)['gpus'][gpu], indent=4, sort_keys=True)
+        return json.dumps(self.status['gpus'][gpu], indent=4, sort_keys=True)
 
     @property
     def stale(self):
@@ -203,76 +232,29 @@ class Threshold(base):
     emails = db.Column(ARRAY(db.String))
 
     def report_condition(self, message, typ, new_state):
+        """ Records a change in error state, returning the (address, message)
+        alerts to email about it. They're left to the caller to queue once
+        the change is committed, so a rolled back report sends nothing. """
         db.session.refresh(self, lockmode='update')
         # we got beat in a race condition...
         if getattr(self, typ) == new_state:
             current_app.logger.info("Ignored sending of report_condition due "
                                     "to race condition resolution")
-            return
+            return []
         setattr(self, typ, new_state)
 
         # if we shouldn't notify of state going up
         if new_state and not self.green_notif:
-            return
+            return []
         current_app.logger.info("Reporting '{}' for worker {}; addr: {}"
                                 .format(message, self.worker, self.user))
 
-        # get all the events that happened for these addresses in the last hour
-        hour_ago = datetime.utcnow() - timedelta(hours=1)
-        events = (Event.query.filter_by(worker=self.worker, user=self.user).
-                  filter(Event.address.in_(self.emails)).
-                  filter(Event.time >= hour_ago).all())
+        econf = current_app.config['email']
+        if not econf.get('enabled', True):
+            current_app.logger.warn("Skipping actual email send because disabled!")
+            return []
 
-        try:
-            econf = current_app.config['email']
-            if not econf.get('enabled', True):
-                current_app.logger.warn("Skipping actual email send because disabled!")
-                return True
-
-            send_addr = econf['send_address']
-            host = smtplib.SMTP(
-                host=econf['server'],
-                port=econf['port'],
-                local_hostname=econf['ehlo'],
-                timeout=econf['timeout'])
-            host.set_debuglevel(econf['debug'])
-            if econf['tls']:
-                host.starttls()
-            if econf['ehlo']:
-                host.ehlo()
-
-            host.login(econf['username'], econf['password'])
-            email_limit = current_app.config.get('emails_per_hour_cap', 6)
-            # Send the message via our own SMTP server, but don't include the
-            # envelope header.
-            for address in self.emails:
-                count = len([a for a in events if a.address == address])
-                if count <= email_limit:
-                    msg = MIMEText('http://simpledoge.com/{}'.format(self.user))
-                    msg['Subject'] = message
-                    msg['From'] = 'Simple Doge <simpledogepool@gmail.com>'
-                    msg['To'] = address
-                    host.sendmail(send_addr, address, msg.as_string())
-                else:
-                    current_app.logger.info(
-                        "Not sending email to {} because over limit"
-                        .format(address, email_limit))
-                ev = Event(user=self.user, worker=self.worker, address=address)
-                db.session.add(ev)
-        except smtplib.SMTPException:
-            current_app.logger.warn('Email unable to send', exc_info=True)
-            return False
-        else:
-            host.quit()
-
-        return True
-
-
-class Event(base):
-    time = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow)
-    user = db.Column(db.String, primary_key=True)
-    worker = db.Column(db.String, primary_key=True)
-    address = db.Column(db.String, primary_key=True)
+        return [(address, message) for address in self.emails]
 
 
 class MergeAddress(base):
@@ -324,6 +306,31 @@ class Transfer(AbstractConcreteBase, base):
         else:
             return "Payout Pending"
 
+    @classmethod
+    def pending_totals(cls, merged_type=None, lock=False):
+        """ Sums up the unpaid, unlocked transfers from mature blocks for each
+        user, returning a list of (user, total_amount, [ids]). With lock the
+        transfers are locked in the same statement, so a concurrent caller
+        can never receive the same ids. """
+        if lock:
+            pending = """UPDATE {0} SET locked = TRUE FROM block
+                         WHERE {0}.blockhash = block.hash AND block.mature
+                         AND {0}.transaction_id IS NULL AND NOT {0}.locked
+                         AND {0}.merged_type IS NOT DISTINCT FROM :merged_type
+                         RETURNING {0}."user", {0}.amount, {0}.id"""
+        else:
+            pending = """SELECT {0}."user", {0}.amount, {0}.id
+                         FROM {0} JOIN block ON {0}.blockhash = block.hash
+                         WHERE block.mature
+                         AND {0}.transaction_id IS NULL AND NOT {0}.locked
+                         AND {0}.merged_type IS NOT DISTINCT FROM :merged_type"""
+        query = ("""WITH pending AS ({})
+                    SELECT "user", sum(amount)::bigint, array_agg(id)
+                    FROM pending GROUP BY "user" """
+                 .format(pending.format(cls.__tablename__)))
+        res = db.session.execute(query, {'merged_type': merged_type})
+        return [(user, amount, ids) for user, amount, ids in res]
+
     @property
     def explorer_link(self):
         if not self.transaction_id:
@@ -549,6 +556,31 @@ class DeviceTimeSlice(AbstractConcreteBase, SliceMixin, base):
     def make_key(self):
         return self.key(user=self.user, worker=self.worker, device=self.device)
 
+    @classmethod
+    def bulk_upsert(cls, values):
+        """ Writes a dictionary of {(user, worker, device, time): value} in a
+        single statement, overwriting the value of any slices that already
+        exist like a merge would. """
+        if not values:
+            return
+        rows = []
+        params = {}
+        for i, ((user, worker, device, time), value) in enumerate(values.iteritems()):
+            rows.append("(:u{0}, :w{0}, :d{0}, :t{0}, :v{0})".format(i))
+            params.update({'u%d' % i: user, 'w%d' % i: worker, 'd%d' % i: device,
+                           't%d' % i: time, 'v%d' % i: value})
+        db.session.execute("""
+            WITH data ("user", worker, device, time, value) AS (VALUES {1}),
+            updated AS (
+                UPDATE {0} SET value = data.value FROM data
+                WHERE {0}."user" = data."user" AND {0}.worker = data.worker
+                AND {0}.device = data.device AND {0}.time = data.time
+                RETURNING {0}."user", {0}.worker, {0}.device, {0}.time)
+            INSERT INTO {0} ("user", worker, device, time, value)
+            SELECT data.* FROM data LEFT JOIN updated USING ("user", worker, device, time)
+            WHERE updated.time IS NULL""".format(cls.__tablename__, ", ".join(rows)),
+            params)
+
 
 class TypeTimeSlice(AbstractConcreteBase, SliceMixin, base):
     """ An time abstracted data sample that pertains to a single workers single
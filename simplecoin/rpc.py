@@ -1,4 +1,5 @@
 import os
+import json
 import logging
 import sys
 import argparse
@@ -11,7 +12,8 @@ from itsdangerous import TimedSerializer, BadData
 
 import requests
 from bitcoinrpc.authproxy import JSONRPCException
-from .coinserv_cmds import payout_many
+from cryptokit.base58 import get_bcaddress_version
+from .coinserv_cmds import payout_many, batch_call
 from . import create_app, coinserv, merge_coinserv
 
 
@@ -75,7 +77,8 @@ class RPCClient(object):
 
     def confirm_trans(self, simulate=False):
         proc_pids = []
-        res = self.get('api/transaction?__filter_by={"confirmed":false}', signed=False)
+        res = self.get('api/transaction?__filter_by={"confirmed":false}'
+                       '&fields=txid,merged_type', signed=False)
         if not res['success']:
             logger.error("Failure from remote: {}".format(res))
             return
@@ -110,9 +113,54 @@ class RPCClient(object):
         logger.info("Resetting requested bids and pids")
         self.post('update_payouts', data=data)
 
-    def validate_address(self, conn, address):
-        ret = conn.validateaddress(address)
-        return ret['isvalid']
+    def load_address_cache(self):
+        path = os.path.expanduser(self.config.get(
+            'address_cache', '~/.simplecoin_address_cache.json'))
+        try:
+            with open(path) as f:
+                return path, json.load(f)
+        except (IOError, ValueError):
+            return path, {}
+
+    def validate_addresses(self, addresses, merged=None):
+        """ Returns the set of valid addresses out of those given. Addresses
+        with a bad base58 checksum are rejected locally, addresses we've
+        already seen validated are taken from the on disk cache, and the rest
+        are checked with a single batch of validateaddress calls. """
+        path, cache = self.load_address_cache()
+        known = set(cache.get(merged or 'main', []))
+
+        unknown = []
+        for address in set(addresses):
+            if address in known:
+                continue
+            try:
+                version = get_bcaddress_version(address)
+            except Exception:
+                version = None
+            if version is None:
+                logger.debug("Address {} failed the base58 check"
+                             .format(address))
+                continue
+            unknown.append(address)
+
+        if unknown:
+            logger.info("Validating {} new addresses with the coinserver"
+                        .format(len(unknown)))
+            results = batch_call([('validateaddress', [address])
+                                  for address in unknown], merged=merged)
+            for address, ret in zip(unknown, results):
+                if isinstance(ret, JSONRPCException):
+                    raise RPCException("Error validating {}: {}"
+                                       .format(address, ret.error))
+                if ret['isvalid']:
+                    known.add(address)
+
+            cache[merged or 'main'] = sorted(known)
+            with open(path, 'w') as f:
+                json.dump(cache, f)
+
+        return known.intersection(addresses)
 
     def proc_trans(self, simulate=False, merged=None):
         logger.info("Running payouts for merged = {}".format(merged))
@@ -134,8 +182,9 @@ class RPCClient(object):
         if lock:
             assert lock_res
 
-        pids = [t[2] for t in payouts]
-        bids = [t[2] for t in bonus_payouts]
+        # the server sends a (user, total amount, [ids]) entry per user
+        pids = [id for user, amount, ids in payouts for id in ids]
+        bids = [id for user, amount, ids in bonus_payouts for id in ids]
         if not simulate:
             logger.warn("Locked all recieved payout ids and bonus payout ids. In "
                         "the event of an error, run the following command to unlock"
@@ -153,25 +202,26 @@ class RPCClient(object):
         # builds two dictionaries, one that tracks the total payouts to a user,
         # and another that tracks all the payout ids (pids) giving that amount
         # to the user
+        valid = self.validate_addresses(
+            [user for user, amount, ids in payouts + bonus_payouts],
+            merged=merged)
         totals = {}
         pids = {}
         bids = {}
-        for user, amount, id in payouts:
-            if self.validate_address(conn, user):
+        for user, amount, ids in payouts:
+            if user in valid:
                 totals.setdefault(user, 0)
                 totals[user] += amount
-                pids.setdefault(user, [])
-                pids[user].append(id)
+                pids[user] = ids
             else:
                 logger.warn("User {} has been excluded due to invalid address"
                             .format(user))
 
-        for user, amount, id in bonus_payouts:
-            if self.validate_address(conn, user):
+        for user, amount, ids in bonus_payouts:
+            if user in valid:
                 totals.setdefault(user, 0)
                 totals[user] += amount
-                bids.setdefault(user, [])
-                bids[user].append(id)
+                bids[user] = ids
             else:
                 logger.warn("User {} has been excluded due to invalid address"
                             .format(user))
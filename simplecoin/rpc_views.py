@@ -20,21 +20,12 @@ def get_payouts():
     if isinstance(args, dict) and args['merged']:
         merged = args['merged']
 
-    payouts = (Payout.query.filter_by(transaction_id=None, locked=False, merged_type=merged).
-               join(Payout.block, aliased=True).filter_by(mature=True)).all()
-    bonus_payouts = (BonusPayout.query.filter_by(transaction_id=None, locked=False, merged_type=merged).
-                     join(BonusPayout.block, aliased=True).filter_by(mature=True)).all()
-
-    pids = [(p.user, p.amount, p.id) for p in payouts]
-    bids = [(p.user, p.amount, p.id) for p in bonus_payouts]
-
     if lock:
         current_app.logger.info("Locking pids and bids at retriever request.")
-        for payout in payouts:
-            payout.locked = True
-        for payout in bonus_payouts:
-            payout.locked = True
-        db.session.commit()
+    # lists of (user, total amount, [ids]), summed and locked by the database
+    pids = Payout.pending_totals(merged_type=merged, lock=lock)
+    bids = BonusPayout.pending_totals(merged_type=merged, lock=lock)
+    db.session.commit()
     return s.dumps([pids, bids, lock])
 
 
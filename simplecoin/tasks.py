@@ -1,6 +1,11 @@
 from math import ceil, floor
+from multiprocessing.pool import ThreadPool
+from functools import partial
+from email.mime.text import MIMEText
 import json
 import logging
+import smtplib
+import socket
 import datetime
 import time
 
@@ -10,19 +15,23 @@ from time import sleep
 import sqlalchemy
 
 from celery import Celery
+from celery.signals import task_postrun
 from simplecoin import db, coinserv, cache, merge_coinserv
-from simplecoin.utils import last_block_share_id_nocache, last_block_time_nocache, last_block_time, get_round_shares, \
-    last_block_share_id
+from simplecoin.utils import last_block_share_id_nocache, last_block_time_nocache, \
+    last_block_share_id, publish_live, get_pool_hashrate, get_adj_round_shares, \
+    log_pool_stats, update_worker_summaries, update_presence, online_worker_count
+from simplecoin.coinserv_cmds import batch_call
+from simplecoin.thresholds import (ThresholdEngine, record_seen, forget_seen,
+                                   prune_seen)
 from simplecoin.models import (
     Share, Block, OneMinuteShare, Payout, Transaction, Blob, FiveMinuteShare,
     Status, OneMinuteReject, OneMinuteTemperature, FiveMinuteReject,
-    OneMinuteHashrate, Threshold, Event, DonationPercent, BonusPayout,
+    OneMinuteHashrate, Threshold, DonationPercent, BonusPayout,
     FiveMinuteTemperature, FiveMinuteHashrate, FiveMinuteType, OneMinuteType,
     MergeAddress)
 from sqlalchemy.sql import select
 from cryptokit import bits_to_shares, bits_to_difficulty
 
-from bitcoinrpc import CoinRPCException
 from celery.utils.log import get_task_logger
 import requests
 
@@ -31,6 +40,11 @@ logger = get_task_logger(__name__)
 celery = Celery('simplecoin')
 
 
+@task_postrun.connect
+def report_pools(**kwargs):
+    log_pool_stats()
+
+
 def get_sharemap(start_id, shares_to_fetch, chunk_size=None, sleep_interval=None):
     """ Give a share id to start at and a number of shares to fetch (round size),
     returns a map of {user_address: share_count} format and how many shares
@@ -89,35 +103,72 @@ def get_sharemap(start_id, shares_to_fetch, chunk_size=None, sleep_interval=None
     return user_shares, shares_to_fetch - remain
 
 
+def fetch_monitor(url, timeout):
+    try:
+        return requests.get(url, timeout=timeout).json()
+    except Exception:
+        logger.warn("Unable to connect to monitor at {}".format(url))
+
+
+def poll_monitors():
+    """ Fetches the client list from every powerpool monitor in parallel,
+    returning them in monitor_addrs order. A monitor that doesn't answer
+    gives the last list it sent instead, or None if it's been too long. """
+    timeout = current_app.config.get('monitor_timeout', 5)
+    urls = [pp_config['mon_address'] + '/clients'
+            for pp_config in current_app.config['monitor_addrs']]
+    if not urls:
+        return []
+
+    pool = ThreadPool(len(urls))
+    try:
+        data = pool.map(lambda url: fetch_monitor(url, timeout), urls)
+    finally:
+        pool.close()
+        pool.join()
+
+    # monitors that didn't answer fall back to the last data they gave us
+    for i, url in enumerate(urls):
+        if data[i] is None:
+            data[i] = cache.get('monitor_last_' + url)
+        else:
+            cache.set('monitor_last_' + url, data[i], timeout=1200)
+    return data
+
+
 @celery.task(bind=True)
 def update_online_workers(self):
     """
-    Grabs a list of workers from the running powerpool instances and caches
-    them
+    Grabs a list of workers from the running powerpool instances and updates
+    the online presence index and pool worker count with them
     """
     try:
-        users = {}
-        for i, pp_config in enumerate(current_app.config['monitor_addrs']):
-            mon_addr = pp_config['mon_address'] + '/clients'
-            try:
-                req = requests.get(mon_addr)
-                data = req.json()
-            except Exception:
-                logger.warn("Unable to connect to {} to gather worker summary."
-                            .format(mon_addr))
-            else:
-                for address, workers in data['clients'].iteritems():
-                    users.setdefault('addr_online_' + address, [])
-                    for d in workers:
-                        users['addr_online_' + address].append((d['worker'], i))
-
-        cache.set_many(users, timeout=480)
+        for i, data in enumerate(poll_monitors()):
+            if data is None:
+                continue
+            update_presence(i, data['clients'])
 
+        total_workers = online_worker_count()
+        cache.set('total_workers', total_workers, timeout=1200)
+        publish_live('workers', workers=total_workers)
     except Exception as exc:
         logger.error("Unhandled exception in update_online_workers", exc_info=True)
         raise self.retry(exc=exc)
 
 
+@celery.task(bind=True)
+def update_worker_stats(self):
+    """
+    Refreshes the per worker share totals and rates shown on the dashboard
+    """
+    try:
+        count = update_worker_summaries()
+        logger.info("Updated summaries for {} workers".format(count))
+    except Exception as exc:
+        logger.error("Unhandled exception in update_worker_stats", exc_info=True)
+        raise self.retry(exc=exc)
+
+
 @celery.task(bind=True)
 def update_pplns_est(self):
     """
@@ -178,16 +229,20 @@ def update_coin_transaction(self):
     Loops through all immature transactions
     """
     try:
-        # Select all unconfirmed transactions
-        unconfirmed = Transaction.query.filter_by(confirmed=False)
-        for tx in unconfirmed:
-            # Check to see if the transaction hash exists in the block chain
-            try:
-                t = coinserv.gettransaction(tx.txid)
-                if t.get('confirmations', 0) >= 6:
+        # Select all unconfirmed transactions, grouped by the coin they're on
+        by_coin = {}
+        for tx in Transaction.query.filter_by(confirmed=False):
+            by_coin.setdefault(tx.merged_type, []).append(tx)
+
+        for merged_type, txs in by_coin.iteritems():
+            # Look up all the transactions on the coinserver in one batch
+            results = batch_call([('gettransaction', [tx.txid]) for tx in txs],
+                                 merged=merged_type)
+            for tx, t in zip(txs, results):
+                if isinstance(t, Exception):
+                    tx.confirmed = False
+                elif t.get('confirmations', 0) >= 6:
                     tx.confirmed = True
-            except CoinRPCException:
-                tx.confirmed = False
 
         db.session.commit()
     except Exception as exc:
@@ -204,39 +259,49 @@ def update_block_state(self):
     then it checks to see if they are now matured.
     """
     try:
-        # Select all immature & non-orphaned blocks
-        immature = Block.query.filter_by(mature=False, orphan=False)
-        for block in immature:
-            logger.info("Checking state of {} block height {}"
-                        .format(block.merged_type or "main", block.height))
-            if block.merged_type:
-                merged_cfg = current_app.config['merged_cfg'][block.merged_type]
+        # Select all immature & non-orphaned blocks, grouped by coin
+        by_coin = {}
+        for block in Block.query.filter_by(mature=False, orphan=False):
+            by_coin.setdefault(block.merged_type, []).append(block)
+
+        for merged_type, blocks in by_coin.iteritems():
+            if merged_type:
+                merged_cfg = current_app.config['merged_cfg'][merged_type]
                 mature_diff = merged_cfg['block_mature_confirms']
-                rpc = merge_coinserv[block.merged_type]
             else:
                 mature_diff = current_app.config['block_mature_confirms']
-                rpc = coinserv
-            blockheight = rpc.getblockcount()
-
-            # ensure that our RPC server has more than caught up...
-            if blockheight - 10 < block.height:
-                logger.info("Skipping block {}:{} because blockchain isn't caught up."
-                            "Block is height {} and blockchain is at {}"
-                            .format(block.height, block.hash, block.height, blockheight))
-                continue
 
-            logger.info("Checking block height: {}".format(block.height))
-            # Check to see if the block hash exists in the block chain
-            try:
-                output = rpc.getblock(block.hash)
+            # Fetch the block count and every block we're checking in a
+            # single batch to the coinserver
+            results = batch_call([('getblockcount', [])] +
+                                 [('getblock', [block.hash]) for block in blocks],
+                                 merged=merged_type)
+            blockheight = results[0]
+            if isinstance(blockheight, Exception):
+                raise blockheight
+
+            for block, output in zip(blocks, results[1:]):
+                logger.info("Checking state of {} block height {}"
+                            .format(block.merged_type or "main", block.height))
+
+                # ensure that our RPC server has more than caught up...
+                if blockheight - 10 < block.height:
+                    logger.info("Skipping block {}:{} because blockchain isn't caught up."
+                                "Block is height {} and blockchain is at {}"
+                                .format(block.height, block.hash, block.height, blockheight))
+                    continue
+
+                logger.info("Checking block height: {}".format(block.height))
+                # Check to see if the block hash exists in the block chain
+                if isinstance(output, Exception):
+                    logger.info("Block {}:{} not in coin database, assume orphan!"
+                                .format(block.height, block.hash))
+                    block.orphan = True
+                    continue
+
                 logger.debug("Confirms: {}; Height diff: {}"
                              .format(output['confirmations'],
                                      blockheight - block.height))
-            except CoinRPCException:
-                logger.info("Block {}:{} not in coin database, assume orphan!"
-                            .format(block.height, block.hash))
-                block.orphan = True
-            else:
                 if output['confirmations'] > mature_diff:
                     logger.info("Block {}:{} meets {} confirms, mark mature"
                                 .format(block.height, block.hash, mature_diff))
@@ -246,7 +311,7 @@ def update_block_state(self):
                                 .format(block.height, block.hash, mature_diff))
                     block.orphan = True
 
-            db.session.commit()
+        db.session.commit()
     except Exception as exc:
         logger.error("Unhandled exception in update block status", exc_info=True)
         db.session.rollback()
@@ -321,9 +386,11 @@ def add_block(self, user, height, total_value, transaction_fees, bits,
 
         # Expire cache values for round
         cache.delete_memoized(last_block_share_id)
-        cache.delete_memoized(last_block_time)
-        cache.delete_memoized(get_round_shares)
+        cache.delete('last_block_time')
+        cache.delete('round_shares')
 
+        publish_live('block', height=height, hash=hash_hex, user=user,
+                     merged=merged)
     except Exception as exc:
         logger.error("Unhandled exception in add_block", exc_info=True)
         db.session.rollback()
@@ -358,6 +425,9 @@ def add_one_minute(self, user, valid_shares, minute, worker='', dup_shares=0,
 
         # we want to log how much of each type of reject for the whole pool
         if user == "pool":
+            # record when the latest pool wide slice arrived. The API uses
+            # this to tell clients whether the stats have changed
+            cache.set('last_one_minute', minute, timeout=3600)
             if low_diff_shares:
                 count_share(OneMinuteReject, low_diff_shares, user_="pool_low_diff")
             if dup_shares:
@@ -375,6 +445,16 @@ def add_one_minute(self, user, valid_shares, minute, worker='', dup_shares=0,
         db.session.rollback()
         raise self.retry(exc=exc)
 
+    # the shares are committed by now, so a failure here mustn't retry the
+    # task and count them twice
+    if user == "pool":
+        try:
+            hashrate = get_pool_hashrate()
+            publish_live('pool', hashrate=hashrate,
+                         round_shares=get_adj_round_shares(hashrate))
+        except Exception:
+            logger.warn("Unable to publish pool live stats", exc_info=True)
+
 
 @celery.task(bind=True)
 def new_block(self, blockheight, bits=None, reward=None):
@@ -716,129 +796,321 @@ def compress_five_minute(self):
 @celery.task(bind=True)
 def general_cleanup(self):
     """ Cleans up old database items.
-    - Event for email rate limiting older than 1 hr.
-    - Old status messages
+    - Old status messages, and the last seen times that went with them
     """
     try:
         now = datetime.datetime.utcnow()
         ten_hour_ago = now - datetime.timedelta(hours=12)
-        one_hour_ago = now - datetime.timedelta(hours=1)
         Status.query.filter(Status.time < ten_hour_ago).delete()
-        Event.query.filter(Event.time < one_hour_ago).delete()
         db.session.commit()
+        pruned = prune_seen(time.time() - 12 * 3600)
+        logger.info("Pruned {} stale worker last seen times".format(pruned))
     except Exception:
         logger.error("Unhandled exception in remove_old_statuses", exc_info=True)
         db.session.rollback()
 
 
-@celery.task(bind=True)
-def agent_receive(self, address, worker, typ, payload, timestamp):
-    """ Accepts ppagent data that is forwarded from powerpool and manages
-    adding it to the database and triggering alerts as needed. """
-    # convert unix timestamp to datetime
-    dt = datetime.datetime.utcfromtimestamp(timestamp)
-
-    def inject_device_stat(cls, device, value):
-        if value:
-            stat = cls(user=address, worker=worker, device=device, value=value,
-                       time=dt)
-            db.session.merge(stat)
+def in_savepoint(func, attempts=2):
+    """ Runs func in its own savepoint, retrying it if it collides with a
+    concurrent insert. If it still fails only its own work is rolled back,
+    and False is returned. """
+    for attempt in xrange(attempts):
+        db.session.begin_nested()
+        try:
+            func()
+            db.session.commit()
+            return True
+        except sqlalchemy.exc.IntegrityError:
+            db.session.rollback()
+    return False
+
+
+def ingest_agent_messages(messages):
+    """ Adds a list of (address, worker, typ, payload, timestamp) ppagent
+    messages to the database in one transaction. Each message is written in
+    its own savepoint, so one that conflicts only loses itself. Device stats
+    are written with one upsert per table, and threshold conditions are
+    detected from the cached threshold map so a Threshold is only loaded when
+    its state actually changes. """
+    engine = ThresholdEngine()
+    device_stats = {OneMinuteTemperature: {}, OneMinuteHashrate: {}}
+    seen = {}
+    # workers whose thresholds were removed, no longer needing a last seen
+    unwatched = []
+
+    def set_thresholds(address, worker, payload):
+        try:
+            if not payload:
+                # if they didn't list valid email key we want to remove
+                Threshold.query.filter_by(worker=worker, user=address).delete()
+                unwatched.append((address, worker))
+            else:
+                new = Threshold(
+                    worker=worker,
+                    user=address,
+                    green_notif=not payload.get('no_green_notif', False),
+                    temp_thresh=payload.get('overheat'),
+                    hashrate_thresh=payload.get('lowhashrate'),
+                    offline_thresh=payload.get('offline'),
+                    emails=payload['emails'][:4])
+                db.session.merge(new)
+        except KeyError:
+            # assume they're trying to remove the thresholds...
+            Threshold.query.filter_by(worker=worker, user=address).delete()
+            unwatched.append((address, worker))
+            logger.warn("Bad payload was sent as Threshold data: {}"
+                        .format(payload))
+
+    def set_status(address, worker, payload, dt):
+        values = Status.derive(payload)
+        values.update(status=payload, time=dt)
+        ret = (db.session.query(Status).filter_by(user=address, worker=worker).
+               update(values))
+        # if the update affected nothing
+        if ret == 0:
+            new = Status(user=address, worker=worker, **values)
+            db.session.add(new)
+
+    for address, worker, typ, payload, timestamp in messages:
+        # convert unix timestamp to datetime
+        dt = datetime.datetime.utcfromtimestamp(timestamp)
 
-    try:
         # if they passed a threshold we should update the database object
         if typ == "thresholds":
-            try:
-                if not payload:
-                    # if they didn't list valid email key we want to remove
-                    Threshold.query.filter_by(worker=worker, user=address).delete()
-                else:
-                    thresh = Threshold(
-                        worker=worker,
-                        user=address,
-                        green_notif=not payload.get('no_green_notif', False),
-                        temp_thresh=payload.get('overheat'),
-                        hashrate_thresh=payload.get('lowhashrate'),
-                        offline_thresh=payload.get('offline'),
-                        emails=payload['emails'][:4])
-                    db.session.merge(thresh)
-            except KeyError:
-                # assume they're trying to remove the thresholds...
-                Threshold.query.filter_by(worker=worker, user=address).delete()
-                logger.warn("Bad payload was sent as Threshold data: {}"
-                            .format(payload))
-            db.session.commit()
-            return
+            if in_savepoint(partial(set_thresholds, address, worker, payload)):
+                # stop checking against the old thresholds for the rest of the batch
+                engine.forget(address, worker)
+            else:
+                logger.warn("Unable to save thresholds for {}.{}, skipping"
+                            .format(address, worker))
+
         elif typ == 'status':
-            ret = (db.session.query(Status).filter_by(user=address, worker=worker).
-                   update({"status": json.dumps(payload), "time": dt}))
-            # if the update affected nothing
-            if ret == 0:
-                new = Status(user=address, worker=worker,
-                             status=json.dumps(payload), time=dt)
-                db.session.add(new)
-            db.session.commit()
-            return
+            # a concurrent insert of the same worker's first status is
+            # retried as an update
+            if in_savepoint(partial(set_status, address, worker, payload, dt)):
+                seen[(address, worker)] = timestamp
+            else:
+                logger.warn("Unable to save status for {}.{}, skipping"
+                            .format(address, worker))
 
-        # the two status messages can trigger a threshold condition, so we need
-        # to load the threshold to check
-        thresh = Threshold.query.filter_by(worker=worker, user=address).first()
-        if typ == 'temp':
-            # track the overheated cards
-            overheat_cards = []
-            temps = []
+        elif typ == 'temp':
             for i, value in enumerate(payload):
-                inject_device_stat(OneMinuteTemperature, i, value)
-                # report over temperature
-                if thresh and value >= thresh.temp_thresh:
-                    overheat_cards.append(str(i))
-                    temps.append(str(value))
-
-            if overheat_cards and not thresh.temp_err:
-                s = "s" if len(overheat_cards) else ""
-                thresh.report_condition(
-                    "Worker {}, overheat on card{s} {}, temp{s} {}"
-                    .format(worker, ', '.join(overheat_cards), ', '.join(temps),
-                            s=s),
-                    'temp_err', True)
-            elif not overheat_cards and thresh and thresh.temp_err:
-                thresh.report_condition(
-                    "Worker {} overheat condition relieved".format(worker),
-                    'temp_err', False)
+                if value:
+                    device_stats[OneMinuteTemperature][(address, worker, i, dt)] = value
+            engine.check_temp(address, worker, payload)
 
         elif typ == 'hashrate':
             for i, value in enumerate(payload):
                 # multiply by a million to turn megahashes to hashes
-                inject_device_stat(OneMinuteHashrate, i, value * 1000000)
-
-            # do threshold checking if they have one set
-            if thresh:
-                hr = sum(payload) * 1000
-                if int(hr) == 0:
-                    logger.warn("Entry with 0 hashrate. Worker {}; User {}".format(worker, address))
-                else:
-                    low_hash = thresh and hr <= thresh.hashrate_thresh
-                    if low_hash and not thresh.hashrate_err:
-                        thresh.report_condition(
-                            "Worker {} low hashrate condition, hashrate {} KH/s"
-                            .format(worker, hr), 'hashrate_err', True)
-                    elif not low_hash and thresh.hashrate_err:
-                        thresh.report_condition(
-                            "Worker {} low hashrate condition resolved, hashrate {} KH/s"
-                            .format(worker, hr), 'hashrate_err', False)
+                if value:
+                    device_stats[OneMinuteHashrate][(address, worker, i, dt)] = value * 1000000
+            engine.check_hashrate(address, worker, payload)
         else:
             logger.warning("Powerpool sent an unkown agent message of type {}"
                            .format(typ))
+
+    for cls, values in device_stats.iteritems():
+        # a slice inserted by a concurrent batch makes the upsert collide,
+        # running it again updates that slice instead
+        if not in_savepoint(partial(cls.bulk_upsert, values), attempts=3):
+            logger.warn("Unable to upsert {} {} slices, skipping"
+                        .format(len(values), cls.__name__))
+    engine.apply()
+
+    db.session.commit()
+    forget_seen([key for key in unwatched if key not in seen])
+    record_seen(seen)
+    engine.finish()
+
+
+# the worker's SMTP connection, kept open between sends
+smtp_conn = [None]
+
+
+def smtp_host():
+    """ Returns the open SMTP connection, reconnecting if the server has
+    dropped it """
+    host = smtp_conn[0]
+    if host is not None:
         try:
-            db.session.commit()
-        except sqlalchemy.exc.IntegrityError:
-            db.session.rollback()
-            logger.warn("Received a duplicate agent msg of typ {}, ignoring...!"
-                        .format(typ))
+            if host.noop()[0] == 250:
+                return host
+        except (smtplib.SMTPException, socket.error):
+            pass
+
+    econf = current_app.config['email']
+    host = smtplib.SMTP(
+        host=econf['server'],
+        port=econf['port'],
+        local_hostname=econf['ehlo'],
+        timeout=econf['timeout'])
+    host.set_debuglevel(econf['debug'])
+    if econf['tls']:
+        host.starttls()
+    if econf['ehlo']:
+        host.ehlo()
+    host.login(econf['username'], econf['password'])
+    smtp_conn[0] = host
+    return host
+
+
+def email_allowed(address):
+    """ Counts an alert against the address's emails_per_hour_cap and says
+    whether it's still under. Approximates a sliding hour from this hour's
+    count plus the share of last hour's count still inside the window, so
+    it's two redis keys per address that expire on their own. """
+    now = time.time()
+    window = 3600
+    bucket = int(now // window)
+    key = 'email_count_{}_'.format(address)
+    pipe = cache.cache._client.pipeline()
+    pipe.get(key + str(bucket - 1))
+    pipe.incr(key + str(bucket))
+    pipe.expire(key + str(bucket), window * 2)
+    prev, current, _ = pipe.execute()
+    weight = 1 - (now % window) / window
+    # alerts before this one, as the cap has always been checked
+    count = int(prev or 0) * weight + current - 1
+    return count <= current_app.config.get('emails_per_hour_cap', 6)
+
+
+def queue_alert(address, user, message):
+    """ Adds an alert to the pending digest for an email address, returning
+    False instead if the address is over its hourly cap. A send is scheduled
+    for email_digest_window seconds later unless one is already pending, so
+    anything else reported to that address in the meantime goes out in the
+    same email. The pending flag expires on its own, so a send that never
+    ran can't hold up the address's email for good. """
+    if not email_allowed(address):
+        return False
+
+    window = current_app.config.get('email_digest_window', 60)
+    key = 'alert_digest_' + address
+    pipe = cache.cache._client.pipeline()
+    pipe.rpush(key, json.dumps({'user': user, 'message': message}))
+    # alerts that never get sent are dropped after a day
+    pipe.expire(key, 86400)
+    pipe.set(key + '_pending', 1, ex=window * 2, nx=True)
+    _, _, schedule = pipe.execute()
+    if schedule:
+        # routed to the email queue by celeryconfig
+        send_alert_digest.apply_async(args=[address], countdown=window)
+    return True
+
+
+@celery.task(bind=True, default_retry_delay=60)
+def send_alert_digest(self, address):
+    """ Sends all the alerts pending for an email address in one email """
+    key = 'alert_digest_' + address
+    pipe = cache.cache._client.pipeline()
+    pipe.lrange(key, 0, -1)
+    pipe.delete(key)
+    # anything queued from here on schedules its own send
+    pipe.delete(key + '_pending')
+    raw, _, _ = pipe.execute()
+    if not raw:
+        return
+    alerts = [json.loads(alert) for alert in raw]
+
+    lines = ['{}\nhttp://simpledoge.com/{}'.format(a['message'], a['user'])
+             for a in alerts]
+    msg = MIMEText('\n\n'.join(lines))
+    if len(alerts) == 1:
+        msg['Subject'] = alerts[0]['message']
+    else:
+        msg['Subject'] = "{} worker alerts".format(len(alerts))
+    msg['From'] = 'Simple Doge <simpledogepool@gmail.com>'
+    msg['To'] = address
+
+    try:
+        smtp_host().sendmail(current_app.config['email']['send_address'],
+                             address, msg.as_string())
+    except (smtplib.SMTPException, socket.error) as exc:
+        logger.warn('Email unable to send', exc_info=True)
+        smtp_conn[0] = None
+        # put them back to go out with the retry. if the retries run out
+        # they're sent by the next alert's digest, or expire
+        pipe = cache.cache._client.pipeline()
+        pipe.lpush(key, *reversed(raw))
+        pipe.expire(key, 86400)
+        pipe.execute()
+        raise self.retry(exc=exc)
+
+
+@celery.task(bind=True)
+def agent_receive(self, address, worker, typ, payload, timestamp):
+    """ Accepts ppagent data that is forwarded from powerpool and manages
+    adding it to the database and triggering alerts as needed. """
+    try:
+        ingest_agent_messages([(address, worker, typ, payload, timestamp)])
     except Exception:
         logger.error("Unhandled exception in update_status", exc_info=True)
         db.session.rollback()
 
 
+@celery.task(bind=True)
+def agent_receive_many(self, messages):
+    """ Like agent_receive, but accepts a list of messages, each a list of
+    agent_receive's arguments, and handles them all in one transaction. """
+    try:
+        ingest_agent_messages(messages)
+    except Exception:
+        logger.error("Unhandled exception in agent_receive_many", exc_info=True)
+        db.session.rollback()
+
+
+# pushes a difficulty onto a capped list, keeping a running sum of the list
+# in a separate key so the average never needs the whole list re-summed
+ROLLING_AVG_LUA = """
+redis.call('lpush', KEYS[1], ARGV[1])
+local total = redis.call('incrbyfloat', KEYS[2], ARGV[1])
+local count = redis.call('llen', KEYS[1])
+if count > tonumber(ARGV[2]) then
+    local old = redis.call('rpop', KEYS[1])
+    total = redis.call('incrbyfloat', KEYS[2], '-' .. old)
+    count = count - 1
+end
+return {total, count}
+"""
+
+
+def reset_rolling_diff(prefix, size=500):
+    """ Rebuilds the running sum of the rolling difficulty list from scratch,
+    bounding the float drift that builds up from adding and subtracting. If
+    the list doesn't exist yet it's seeded from the raw bits kept in the old
+    block_cache list, so the average doesn't restart from a single block. """
+    client = cache.cache._client
+    diffs = [float(diff) for diff in client.lrange(prefix + 'diff_cache', 0, size - 1)]
+    if not diffs:
+        diffs = [bits_to_difficulty(bits) for bits
+                 in client.lrange(prefix + 'block_cache', 0, size - 1)]
+    pipe = client.pipeline()
+    pipe.delete(prefix + 'diff_cache', prefix + 'diff_sum')
+    if diffs:
+        pipe.rpush(prefix + 'diff_cache', *[repr(diff) for diff in diffs])
+        pipe.set(prefix + 'diff_sum', repr(sum(diffs)))
+    pipe.execute()
+
+# upper bounds in seconds of the coinserver latency histogram buckets
+RPC_LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+
+
+def poll_coinserv(args):
+    """ Checks a coinserver for a new block with a cheap getblockcount, only
+    fetching the much larger block template when the height has moved on.
+    Returns the template (or None if there's no new block), the time taken,
+    and any exception raised. """
+    conn, prev_height = args
+    start = time.time()
+    try:
+        # templates are for the next block, one above the current count
+        if conn.getblockcount() + 1 == prev_height:
+            return None, time.time() - start, None
+        return conn.getblocktemplate(), time.time() - start, None
+    except Exception as exc:
+        return None, time.time() - start, exc
+
+
 @celery.task(bind=True)
 def update_network(self):
     """
@@ -860,13 +1132,20 @@ def update_network(self):
             cache.set(prefix + 'blockheight', gbt['height'], timeout=1200)
             cache.set(prefix + 'difficulty', difficulty, timeout=1200)
             cache.set(prefix + 'reward', gbt['coinbasevalue'], timeout=1200)
-
-            # keep the last 500 blocks in the cache for getting average difficulty
-            cache.cache._client.lpush(prefix + 'block_cache', gbt['bits'])
-            cache.cache._client.ltrim(prefix + 'block_cache', 0, 500)
-            diff_list = cache.cache._client.lrange(prefix + 'block_cache', 0, 500)
-            total_diffs = sum([bits_to_difficulty(diff) for diff in diff_list])
-            cache.set(prefix + 'difficulty_avg', total_diffs / len(diff_list), timeout=120 * 60)
+            publish_live('network', merged=curr, height=gbt['height'],
+                         difficulty=difficulty, reward=gbt['coinbasevalue'])
+
+            # keep a rolling sum of the last 500 block difficulties for getting
+            # average difficulty. seeded on the first run, and re-summed every
+            # hundred blocks
+            if (gbt['height'] % 100 == 0 or
+                    not cache.cache._client.exists(prefix + 'diff_sum')):
+                reset_rolling_diff(prefix)
+            rolling_avg = cache.cache._client.register_script(ROLLING_AVG_LUA)
+            total_diffs, count = rolling_avg(
+                keys=[prefix + 'diff_cache', prefix + 'diff_sum'],
+                args=[repr(difficulty), 500])
+            cache.set(prefix + 'difficulty_avg', float(total_diffs) / int(count), timeout=120 * 60)
 
             # add the difficulty as a one minute share
             now = datetime.datetime.utcnow()
@@ -882,12 +1161,30 @@ def update_network(self):
                 slc.value = ((difficulty * 1000) + slc.value) / 2
                 db.session.commit()
 
-        for merged_type, conf in current_app.config['merged_cfg'].iteritems():
-            gbt = merge_coinserv[merged_type].getblocktemplate()
-            set_data(gbt, curr=merged_type)
+        # resolve the connections here, the pool threads have no app context
+        coins = merge_coinserv.items()
+        coins.append((None, coinserv._get_current_object()))
+        polls = []
+        for curr, conn in coins:
+            prefix = curr + "_" if curr else ""
+            polls.append((conn, cache.get(prefix + 'blockheight')))
 
-        gbt = coinserv.getblocktemplate()
-        set_data(gbt)
+        pool = ThreadPool(len(polls))
+        try:
+            results = pool.map(poll_coinserv, polls)
+        finally:
+            pool.close()
+            pool.join()
+
+        for (curr, conn), (gbt, latency, exc) in zip(coins, results):
+            prefix = curr + "_" if curr else ""
+            bucket = next((str(b) for b in RPC_LATENCY_BUCKETS if latency <= b), 'inf')
+            cache.cache._client.hincrby(prefix + 'rpc_latency', bucket, 1)
+            if exc is not None:
+                logger.error("Failed polling {} coinserver: {}"
+                             .format(curr or 'main', exc))
+            elif gbt is not None:
+                set_data(gbt, curr=curr)
     except Exception:
         logger.error("Unhandled exception in update_network", exc_info=True)
         db.session.rollback()
@@ -896,56 +1193,15 @@ def update_network(self):
 @celery.task(bind=True)
 def check_down(self):
     """
-    Checks for latest OneMinuteShare from users that have a Threshold defined
-    for their downtime.
+    Checks the time each worker with an offline threshold last sent a status,
+    reporting workers that have gone offline or come back.
     """
     try:
-        for thresh in Threshold.query.filter(Threshold.offline_thresh != None):
-            last = Status.query.filter_by(worker=thresh.worker, user=thresh.user).first()
-            if not last:
-                continue
-            diff = int((datetime.datetime.utcnow() - last.time).total_seconds() / 60)
-            if not thresh.offline_err and diff > thresh.offline_thresh:
-                thresh.report_condition("Worker {} offline for {} minutes"
-                                        .format(thresh.worker, diff),
-                                        'offline_err',
-                                        True)
-
-            # if there's an error registered and it's not showing offline
-            elif thresh.offline_err and diff <= thresh.offline_thresh:
-                thresh.report_condition("Worker {} now back online"
-                                        .format(thresh.worker),
-                                        'offline_err',
-                                        False)
-
+        engine = ThresholdEngine()
+        engine.check_offline()
+        engine.apply()
         db.session.commit()
+        engine.finish()
     except Exception:
         logger.error("Unhandled exception in check_down", exc_info=True)
         db.session.rollback()
-
-
-@celery.task(bind=True)
-def server_status(self):
-    """
-    Periodicly poll the backend to get number of workers and throw it in the cache
-    """
-    try:
-        total_workers = 0
-        for i, pp_config in enumerate(current_app.config['monitor_addrs']):
-            mon_addr = pp_config['mon_address']
-            try:
-                req = requests.get(mon_addr)
-                data = req.json()
-            except Exception:
-                logger.warn("Couldn't connect to internal monitor at {}"
-                            .format(mon_addr))
-                continue
-            else:
-                cache.set('stratum_workers_' + str(i),
-                          data['stratum_clients'], timeout=1200)
-                total_workers += data['stratum_clients']
-
-        cache.set('total_workers', total_workers, timeout=1200)
-    except Exception:
-        logger.error("Unhandled exception in server_status", exc_info=True)
-        db.session.rollback()
@@ -0,0 +1,200 @@
+import calendar
+import time
+
+from flask import current_app
+from sqlalchemy.sql import tuple_
+
+from . import cache
+from .models import Threshold, Status
+
+
+# redis hash of the unix time each worker last sent a status, keyed by
+# "address.worker". addresses are base58, so the first '.' always splits them
+LAST_SEEN_KEY = 'worker_last_seen'
+
+
+def threshold_map():
+    """ The thresholds and current error states of every worker that has
+    thresholds set, keyed by (user, worker). Cached so that telemetry can be
+    checked without hitting the database, and dropped whenever a threshold
+    or error state changes. """
+    thresholds = cache.get('threshold_map')
+    if thresholds is None:
+        thresholds = {}
+        for t in Threshold.query:
+            thresholds[(t.user, t.worker)] = dict(
+                temp_thresh=t.temp_thresh, hashrate_thresh=t.hashrate_thresh,
+                offline_thresh=t.offline_thresh, temp_err=t.temp_err,
+                hashrate_err=t.hashrate_err, offline_err=t.offline_err)
+        cache.set('threshold_map', thresholds, timeout=600)
+    return thresholds
+
+
+class ThresholdEngine(object):
+    """ Evaluates worker telemetry against a snapshot of the threshold map.
+    Conditions are edge triggered: one is only recorded when a worker's error
+    state flips, and the snapshot is updated as it goes so repeated readings
+    in a batch don't report the same change twice. Nothing touches the
+    database until `apply` reports the recorded changes. """
+    def __init__(self):
+        self.thresholds = dict((key, dict(val)) for key, val
+                               in threshold_map().iteritems())
+        # (address, worker, message, typ, new_state) of each state change
+        self.conditions = []
+        # (email address, user, message) to send once the changes commit
+        self.alerts = []
+        self.changed = False
+
+    def set_condition(self, address, worker, message, typ, new_state):
+        self.thresholds[(address, worker)][typ] = new_state
+        self.conditions.append((address, worker, message, typ, new_state))
+
+    def forget(self, address, worker):
+        """ Stops checking a worker whose thresholds were just changed """
+        self.thresholds.pop((address, worker), None)
+        self.changed = True
+
+    def check_temp(self, address, worker, temps):
+        thresh = self.thresholds.get((address, worker))
+        if not thresh or thresh['temp_thresh'] is None:
+            return
+
+        # track the overheated cards
+        overheat_cards = []
+        overheat_temps = []
+        for i, value in enumerate(temps):
+            if value >= thresh['temp_thresh']:
+                overheat_cards.append(str(i))
+                overheat_temps.append(str(value))
+
+        if overheat_cards and not thresh['temp_err']:
+            s = "s" if len(overheat_cards) else ""
+            self.set_condition(
+                address, worker,
+                "Worker {}, overheat on card{s} {}, temp{s} {}"
+                .format(worker, ', '.join(overheat_cards),
+                        ', '.join(overheat_temps), s=s),
+                'temp_err', True)
+        elif not overheat_cards and thresh['temp_err']:
+            self.set_condition(
+                address, worker,
+                "Worker {} overheat condition relieved".format(worker),
+                'temp_err', False)
+
+    def check_hashrate(self, address, worker, hashrates):
+        thresh = self.thresholds.get((address, worker))
+        if not thresh:
+            return
+
+        hr = sum(hashrates) * 1000
+        if int(hr) == 0:
+            current_app.logger.warn("Entry with 0 hashrate. Worker {}; User {}"
+                                    .format(worker, address))
+            return
+        low_hash = hr <= thresh['hashrate_thresh']
+        if low_hash and not thresh['hashrate_err']:
+            self.set_condition(
+                address, worker,
+                "Worker {} low hashrate condition, hashrate {} KH/s"
+                .format(worker, hr), 'hashrate_err', True)
+        elif not low_hash and thresh['hashrate_err']:
+            self.set_condition(
+                address, worker,
+                "Worker {} low hashrate condition resolved, hashrate {} KH/s"
+                .format(worker, hr), 'hashrate_err', False)
+
+    def check_offline(self):
+        """ Checks every worker with an offline threshold against the time it
+        last sent a status, all fetched with one redis call """
+        watched = [key for key, thresh in self.thresholds.iteritems()
+                   if thresh['offline_thresh'] is not None]
+        last_seen = last_seen_times(watched)
+        now = time.time()
+        for (address, worker), seen in zip(watched, last_seen):
+            if seen is None:
+                continue
+            thresh = self.thresholds[(address, worker)]
+            diff = int((now - seen) / 60)
+            if not thresh['offline_err'] and diff > thresh['offline_thresh']:
+                self.set_condition(
+                    address, worker,
+                    "Worker {} offline for {} minutes".format(worker, diff),
+                    'offline_err', True)
+            # if there's an error registered and it's not showing offline
+            elif thresh['offline_err'] and diff <= thresh['offline_thresh']:
+                self.set_condition(
+                    address, worker,
+                    "Worker {} now back online".format(worker),
+                    'offline_err', False)
+
+    def apply(self):
+        """ Reports the recorded state changes. Only the Thresholds that
+        changed are loaded from the database. """
+        for address, worker, message, typ, new_state in self.conditions:
+            thresh = Threshold.query.get((address, worker))
+            if thresh:
+                for email, msg in thresh.report_condition(message, typ, new_state):
+                    self.alerts.append((email, address, msg))
+
+    def finish(self):
+        """ Queues the alert emails and drops the cached threshold map if
+        anything changed, to be called once the changes are committed """
+        # imported here since tasks needs this module
+        from .tasks import queue_alert
+        for email, address, message in self.alerts:
+            if not queue_alert(email, address, message):
+                current_app.logger.info(
+                    "Not sending email to {} because over limit".format(email))
+        if self.conditions or self.changed:
+            cache.delete('threshold_map')
+
+
+def record_seen(seen):
+    """ Records the unix time a worker last sent a status, given a dictionary
+    of {(address, worker): timestamp} """
+    if seen:
+        cache.cache._client.hmset(
+            LAST_SEEN_KEY, {address + '.' + worker: timestamp
+                            for (address, worker), timestamp in seen.iteritems()})
+
+
+def last_seen_times(workers):
+    """ The unix time each (address, worker) last sent a status, or None if
+    it never has. Workers redis doesn't know about yet are looked up from
+    their Status rows in one query and added to redis. """
+    if not workers:
+        return []
+    seen = cache.cache._client.hmget(
+        LAST_SEEN_KEY, [address + '.' + worker for address, worker in workers])
+    seen = [float(t) if t is not None else None for t in seen]
+
+    missing = [key for key, t in zip(workers, seen) if t is None]
+    if missing:
+        found = {}
+        for status in Status.query.filter(
+                tuple_(Status.user, Status.worker).in_(missing)):
+            found[(status.user, status.worker)] = calendar.timegm(
+                status.time.utctimetuple())
+        record_seen(found)
+        seen = [found.get(key) if t is None else t
+                for key, t in zip(workers, seen)]
+    return seen
+
+
+def forget_seen(workers):
+    """ Drops the last seen times of a list of (address, worker) """
+    if workers:
+        cache.cache._client.hdel(
+            LAST_SEEN_KEY, *[address + '.' + worker for address, worker in workers])
+
+
+def prune_seen(before):
+    """ Drops every last seen time older than a unix timestamp, so workers
+    that stop reporting don't stay in the hash forever. Returns the number
+    dropped. """
+    client = cache.cache._client
+    stale = [field for field, seen in client.hgetall(LAST_SEEN_KEY).iteritems()
+             if float(seen) < before]
+    for i in xrange(0, len(stale), 1000):
+        client.hdel(LAST_SEEN_KEY, *stale[i:i + 1000])
+    return len(stale)
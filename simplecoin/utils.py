@@ -1,15 +1,22 @@
 import calendar
 import datetime
+import gzip
+import hashlib
 import time
-import itertools
-
-import yaml
-from flask import current_app, session
-from sqlalchemy.sql import func
+import json
+from cStringIO import StringIO
+from functools import wraps
+
+import redis
+from flask import current_app, session, request, make_response, g
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import (func, select, literal, union_all, tuple_, null,
+                            case, and_)
 from cryptokit.base58 import get_bcaddress_version
 
 from bitcoinrpc import CoinRPCException
-from . import db, coinserv, cache, root
+from . import db, coinserv, cache, content
 from .models import (DonationPercent, OneMinuteReject, OneMinuteShare,
                      FiveMinuteShare, FiveMinuteReject, Payout, BonusPayout,
                      Block, OneHourShare, OneHourReject, Share, Status,
@@ -20,6 +27,24 @@ class CommandException(Exception):
     pass
 
 
+##############################################################################
+# Read replica routing
+##############################################################################
+def read_replica(func):
+    """ Routes the queries the wrapped function makes to the read replica,
+    if one is configured and current. Only for read only code, anything it
+    flushes still goes to the primary. """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        prev = getattr(g, 'use_replica', False)
+        g.use_replica = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            g.use_replica = prev
+    return wrapper
+
+
 @cache.memoize(timeout=3600)
 def all_blocks(merged_type=None):
     return (db.session.query(Block).filter_by(merged_type=merged_type).
@@ -36,9 +61,9 @@ def all_time_shares(address):
     return sum([shares.value for shares in shares])
 
 
-@cache.memoize(timeout=60)
-def last_block_time(merged_type=None):
-    return last_block_time_nocache(merged_type=merged_type)
+@cache.cached(timeout=60, key_prefix='last_block_time')
+def last_block_time():
+    return last_block_time_nocache()
 
 
 def last_block_time_nocache(merged_type=None):
@@ -157,6 +182,22 @@ def compress_typ(typ, workers, address=None, worker=None):
             workers[slc.worker][stamp] += slc.value
 
 
+def columnar_series(series, start, end, step):
+    """ Converts a {key: {timestamp: value}} graph series map into a map of
+    dense value lists aligned to the window starting at `start`, one entry
+    per `step`. Slots without data are left as None. """
+    count = int((end - start) // step) + 1
+    columns = {}
+    for key, stamps in series.iteritems():
+        values = [None] * count
+        for stamp, value in stamps.iteritems():
+            idx = int((stamp - start) // step)
+            if 0 <= idx < count:
+                values[idx] = value
+        columns[key] = values
+    return columns
+
+
 @cache.cached(timeout=60, key_prefix='pool_hashrate')
 def get_pool_hashrate():
     """ Retrieves the pools hashrate average for the last 10 minutes. """
@@ -171,7 +212,7 @@ def get_pool_hashrate():
     return (float(ten_min) * (2 ** 16)) / 600000
 
 
-@cache.memoize(timeout=30)
+@cache.cached(timeout=30, key_prefix='round_shares')
 def get_round_shares():
     """ Retrieves the total shares that have been submitted since the last
     round rollover. """
@@ -180,12 +221,12 @@ def get_round_shares():
     return round_shares, datetime.datetime.utcnow()
 
 
-def get_adj_round_shares(khashrate):
+def get_adj_round_shares(khashrate, round_shares=None):
     """ Since round shares are cached we still want them to update on every
     page reload, so we extrapolate a new value based on computed average
     shares per second for the round, then add that for the time since we
     computed the real value. """
-    round_shares, dt = get_round_shares()
+    round_shares, dt = round_shares or get_round_shares()
     # # compute average shares/second
     now = datetime.datetime.utcnow()
     sps = float(khashrate * 1000) / (2**16)
@@ -193,9 +234,58 @@ def get_adj_round_shares(khashrate):
     return round_shares
 
 
-@cache.cached(timeout=60, key_prefix='alerts')
 def get_alerts():
-    return yaml.load(open(root + '/static/yaml/alerts.yaml'))
+    return content.alerts.load()
+
+
+class PoolSummary(object):
+    """ Round and pool wide information shown in the page header and used by
+    a handful of views. Nothing is looked up until one of the attributes is
+    first accessed, at which point all the cached values are fetched with a
+    single MGET and anything missing is recomputed. """
+    cache_keys = ['total_workers', 'difficulty_avg', 'pool_hashrate',
+                  'round_shares', 'last_block_time']
+
+    def __init__(self):
+        self._loaded = False
+
+    def __getattr__(self, attr):
+        # only called for attributes that haven't been set, so a miss after
+        # loading is a genuine missing attribute
+        if self._loaded or attr.startswith('_'):
+            raise AttributeError(attr)
+        self._load()
+        return getattr(self, attr)
+
+    def _load(self):
+        (workers, average_difficulty, hashrate, round_shares,
+         last_time) = cache.get_many(*self.cache_keys)
+        if hashrate is None:
+            hashrate = get_pool_hashrate()
+        if round_shares is None:
+            round_shares = get_round_shares()
+        if last_time is None:
+            last_time = last_block_time()
+
+        self.round_duration = (datetime.datetime.utcnow() - last_time).total_seconds()
+        self.hashrate = hashrate
+        self.completed_block_shares = get_adj_round_shares(hashrate, round_shares)
+        self.worker_count = workers or 0
+        self.average_difficulty = average_difficulty or 1
+        self.shares_to_solve = self.average_difficulty * (2 ** 16)
+        self.last_n = current_app.config['last_n']
+        self.pplns_size = self.shares_to_solve * self.last_n
+        self.alerts = get_alerts()
+        self._loaded = True
+
+
+def pool_summary():
+    """ Returns the `PoolSummary` for the current request, creating it on
+    first use. """
+    summary = getattr(g, 'pool_summary', None)
+    if summary is None:
+        summary = g.pool_summary = PoolSummary()
+    return summary
 
 
 @cache.memoize(timeout=60)
@@ -252,15 +342,174 @@ def get_pool_acc_rej():
     return reject_total, accept_total
 
 
-def collect_acct_items(address, limit, offset=0, merged_type=None):
-    payouts = (Payout.query.filter_by(user=address, merged_type=merged_type).
-               order_by(Payout.id.desc()).limit(limit).offset(offset))
-    bonuses = (BonusPayout.query.filter_by(user=address, merged_type=merged_type).
-               order_by(BonusPayout.id.desc()).limit(limit).offset(offset))
-    return sorted(itertools.chain(payouts, bonuses),
-                  key=lambda i: i.created_at, reverse=True)
+def keyset_page(query, cols, before=None, after=None, limit=100):
+    """ Fetches a single page of query ordered newest first by the tuple of
+    `cols`. `before` and `after` are cursors (tuples of values for `cols`)
+    taken from the last or first item of a neighbouring page, which avoids the
+    linear cost of large offsets. Returns the rows along with whether a newer
+    and an older page exist. """
+    key = tuple_(*cols)
+    if after is not None:
+        rows = (query.filter(key > tuple_(*after)).order_by(*cols).
+                limit(limit + 1).all())
+        newer = len(rows) > limit
+        return rows[:limit][::-1], newer, True
+
+    if before is not None:
+        query = query.filter(key < tuple_(*before))
+    rows = query.order_by(*[c.desc() for c in cols]).limit(limit + 1).all()
+    return rows[:limit], before is not None, len(rows) > limit
+
+
+def acct_items_page(address, limit, merged_type=None, before=None, after=None):
+    """ Grabs a page of Payouts and BonusPayouts for an address, merged and
+    ordered in SQL by (created_at, id, typ) with a UNION ALL. The two tables
+    have their own id sequences, so typ is needed to break ties. Cursors are
+    (created_at, id, typ) tuples, see `keyset_page` and `acct_item_cursor`. """
+    payouts = (select([literal('payout').label('typ'), Payout.id, Payout.created_at]).
+               where(Payout.user == address).
+               where(Payout.merged_type == merged_type))
+    bonuses = (select([literal('bonus').label('typ'), BonusPayout.id, BonusPayout.created_at]).
+               where(BonusPayout.user == address).
+               where(BonusPayout.merged_type == merged_type))
+    items = union_all(payouts, bonuses).alias('acct_items')
+    rows, newer, older = keyset_page(db.session.query(items.c.typ, items.c.id),
+                                     [items.c.created_at, items.c.id, items.c.typ],
+                                     before=before, after=after, limit=limit)
+
+    # now load the actual objects on this page by primary key
+    objs = {}
+    for typ, model in [('payout', Payout), ('bonus', BonusPayout)]:
+        ids = [id for t, id in rows if t == typ]
+        if ids:
+            objs.update(((typ, obj.id), obj)
+                        for obj in model.query.filter(model.id.in_(ids)))
+    return [objs[row] for row in rows], newer, older
+
+
+def acct_item_cursor(obj):
+    """ The (created_at, id, typ) cursor of a Payout or BonusPayout """
+    typ = 'bonus' if isinstance(obj, BonusPayout) else 'payout'
+    return obj.created_at, obj.id, typ
+
+
+def collect_acct_items(address, limit, merged_type=None):
+    return acct_items_page(address, limit, merged_type=merged_type)[0]
+
+
+# the columns of each row yielded by iter_acct_history
+acct_history_columns = ['type', 'id', 'created_at', 'height', 'blockhash',
+                        'amount', 'transaction_id', 'description']
+
+
+def iter_acct_history(address, merged_type=None, chunk_size=None):
+    """ Iterates over every Payout and BonusPayout for an address, oldest
+    first, as rows of `acct_history_columns`. Uses a server side cursor so
+    memory use stays flat no matter how long the history is. """
+    chunk_size = chunk_size or current_app.config.get('export_chunk_size', 1000)
+    block = Block.__table__
+
+    def history(typ, model, description):
+        tbl = model.__table__
+        return (select([literal(typ).label('type'), tbl.c.id, tbl.c.created_at,
+                        block.c.height, tbl.c.blockhash, tbl.c.amount,
+                        tbl.c.transaction_id, description.label('description')]).
+                select_from(tbl.outerjoin(block, tbl.c.blockhash == block.c.hash)).
+                where(tbl.c.user == address).
+                where(tbl.c.merged_type == merged_type))
+
+    items = union_all(history('payout', Payout, null()),
+                      history('bonus', BonusPayout,
+                              BonusPayout.__table__.c.description)).alias('history')
+    res = (db.engine.execution_options(stream_results=True).
+           execute(select([items]).order_by(items.c.created_at, items.c.id,
+                                            items.c.type)))
+    try:
+        while True:
+            chunk = res.fetchmany(chunk_size)
+            if not chunk:
+                break
+            for row in chunk:
+                yield row
+    finally:
+        res.close()
+
+
+def update_worker_summaries():
+    """ Totals every worker's accepted and rejected shares over the stats
+    window and stores them, along with the rates the dashboard shows, in each
+    address's worker summary hash. Run periodically so that rendering the
+    dashboard doesn't have to, and so that idle workers' numbers age out. """
+    now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+    # for picking out the last 10 minutes worth shares...
+    twelve_ago = now - datetime.timedelta(minutes=12)
+    two_ago = now - datetime.timedelta(minutes=2)
+
+    # (address, worker) -> [accepted, rejected, last 10 minutes of shares]
+    totals = {}
+
+    def add_totals(typ, column):
+        since = typ.floor_time(now) - typ.window
+        last_10 = case([(and_(typ.time >= twelve_ago, typ.time < two_ago),
+                         typ.value)], else_=0)
+        rows = (db.session.query(typ.user, typ.worker, func.sum(typ.value),
+                                 func.sum(last_10)).
+                filter(typ.time >= since).
+                # the pool wide totals are stored under pool users
+                filter(~typ.user.startswith('pool')).
+                group_by(typ.user, typ.worker))
+        for user, worker, total, recent in rows:
+            entry = totals.setdefault((user, worker), [0, 0, 0])
+            entry[column] += int(total)
+            if column == 0:
+                entry[2] += int(recent)
+
+    add_totals(OneMinuteShare, 0)
+    add_totals(FiveMinuteShare, 0)
+    add_totals(OneMinuteReject, 1)
+    add_totals(FiveMinuteReject, 1)
+
+    updated = calendar.timegm(now.utctimetuple())
+    summaries = {}
+    for (address, worker), (accepted, rejected, last_10_shares) in totals.iteritems():
+        if accepted or rejected:
+            efficiency = 100.0 * (float(accepted) / (accepted + rejected))
+        else:
+            efficiency = None
+        summaries.setdefault(address, {})[worker] = json.dumps(dict(
+            accepted=accepted, rejected=rejected,
+            last_10_shares=last_10_shares,
+            last_10_hashrate=((last_10_shares * 65536.0) / 1000000) / 600,
+            efficiency=efficiency, time=updated))
+
+    # each hash is replaced whole so workers that dropped out of the window
+    # go with it. addresses with no shares left expire along with their key
+    pipe = cache.cache._client.pipeline()
+    for address, workers in summaries.iteritems():
+        key = 'worker_summary_' + address
+        pipe.delete(key)
+        pipe.hmset(key, workers)
+        pipe.expire(key, 900)
+    pipe.execute()
+    return len(totals)
+
+
+def worker_summaries(address):
+    """ The worker summaries stored for an address, keyed by worker. If they
+    haven't been refreshed in the last ten minutes the recent hashrate is
+    zeroed rather than shown stale. """
+    now = time.time()
+    summaries = {}
+    for worker, raw in cache.cache._client.hgetall('worker_summary_' + address).iteritems():
+        summary = json.loads(raw)
+        if summary.pop('time') < now - 720:
+            summary['last_10_shares'] = 0
+            summary['last_10_hashrate'] = 0
+        summaries[worker] = summary
+    return summaries
 
 
+@read_replica
 def collect_user_stats(address):
     """ Accumulates all aggregate user data for serving via API or rendering
     into main user stats page """
@@ -286,52 +535,26 @@ def collect_user_stats(address):
     workers = {}
     # blank worker template
     def_worker = {'accepted': 0, 'rejected': 0, 'last_10_shares': 0,
+                  'last_10_hashrate': 0, 'efficiency': None,
                   'online': False, 'status': None, 'server': {}}
-    # for picking out the last 10 minutes worth shares...
-    now = datetime.datetime.utcnow().replace(second=0, microsecond=0)
-    twelve_ago = now - datetime.timedelta(minutes=12)
-    two_ago = now - datetime.timedelta(minutes=2)
-    for m in itertools.chain(get_typ(FiveMinuteShare, address),
-                             get_typ(OneMinuteShare, address)):
-        workers.setdefault(m.worker, def_worker.copy())
-        workers[m.worker]['accepted'] += m.value
-        # if in the right 10 minute window add to list
-        if m.time >= twelve_ago and m.time < two_ago:
-            workers[m.worker]['last_10_shares'] += m.value
-
-    # accumulate reject amount
-    for m in itertools.chain(get_typ(FiveMinuteReject, address),
-                             get_typ(OneMinuteReject, address)):
-        workers.setdefault(m.worker, def_worker.copy())
-        workers[m.worker]['rejected'] += m.value
+    # share totals and rates, kept up to date as shares come in
+    for worker, summary in worker_summaries(address).iteritems():
+        workers.setdefault(worker, def_worker.copy())
+        workers[worker].update(summary)
 
     # grab and collect all the ppagent status information for easy use
     for st in Status.query.filter_by(user=address):
         workers.setdefault(st.worker, def_worker.copy())
-        workers[st.worker]['status'] = st.parsed_status
+        workers[st.worker]['status'] = st.status
         workers[st.worker]['status_stale'] = st.stale
         workers[st.worker]['status_time'] = st.time
-        workers[st.worker]['total_hashrate'] = sum([gpu['MHS av'] for gpu in workers[st.worker]['status']['gpus']])
-        try:
-            workers[st.worker]['wu'] = sum(
-                [(gpu['Difficulty Accepted'] / gpu['Device Elapsed']) * 60
-                 for gpu in workers[st.worker]['status']['gpus']])
-        except KeyError:
-            workers[st.worker]['wu'] = 0
-
-        try:
-            workers[st.worker]['wue'] = workers[st.worker]['wu'] / (workers[st.worker]['total_hashrate']*1000)
-        except ZeroDivisionError:
-            workers[st.worker]['wue'] = 0.0
-
-        ver = workers[st.worker]['status'].get('v', '0.2.0').split('.')
-        try:
-            workers[st.worker]['status_version'] = [int(part) for part in ver]
-        except ValueError:
-            workers[st.worker]['status_version'] = "Unsupp"
+        workers[st.worker]['total_hashrate'] = st.total_mhs or 0
+        workers[st.worker]['wu'] = st.wu or 0
+        workers[st.worker]['wue'] = st.wue
+        workers[st.worker]['status_version'] = st.version or "Unsupp"
 
     # pull online status from cached pull direct from powerpool servers
-    for name, host in cache.get('addr_online_' + address) or []:
+    for name, host in online_workers(address):
         workers.setdefault(name, def_worker.copy())
         workers[name]['online'] = True
         try:
@@ -339,14 +562,6 @@ def collect_user_stats(address):
         except KeyError:
             workers[name]['server'] = ''
 
-    # pre-calculate a few of the values here to abstract view logic
-    for name, w in workers.iteritems():
-        workers[name]['last_10_hashrate'] = ((w['last_10_shares'] * 65536.0) / 1000000) / 600
-        if w['accepted'] or w['rejected']:
-            workers[name]['efficiency'] = 100.0 * (float(w['accepted']) / (w['accepted'] + w['rejected']))
-        else:
-            workers[name]['efficiency'] = None
-
     # sort the workers
     new_workers = []
     for name, data in workers.iteritems():
@@ -430,6 +645,171 @@ def get_pool_eff():
     else:
         return (float(acc) / (acc + rej)) * 100
 
+##############################################################################
+# Online worker presence
+##############################################################################
+# each monitored server has a hash of address -> json list of its online
+# workers at "online_<server index>", and its worker count at
+# "online_count_<server index>". both expire if the server stops reporting
+def update_presence(server, clients, timeout=480):
+    """ Brings a server's presence hash in line with the clients it reports,
+    only writing the addresses whose workers changed since the last update """
+    client = cache.cache._client
+    key = 'online_{}'.format(server)
+    current = {address: json.dumps(sorted([d['worker'] for d in workers]))
+               for address, workers in clients.iteritems()}
+    previous = client.hgetall(key)
+    removed = [address for address in previous if address not in current]
+    changed = {address: workers for address, workers in current.iteritems()
+               if previous.get(address) != workers}
+
+    pipe = client.pipeline()
+    if removed:
+        pipe.hdel(key, *removed)
+    if changed:
+        pipe.hmset(key, changed)
+    pipe.expire(key, timeout)
+    # keywords since redis.Redis and StrictRedis order setex's args differently
+    pipe.setex(name='online_count_{}'.format(server), time=timeout,
+               value=sum([len(workers) for workers in clients.itervalues()]))
+    pipe.execute()
+
+
+def online_workers(address):
+    """ A (worker name, server index) pair for each of an address's online
+    workers """
+    servers = range(len(current_app.config['monitor_addrs']))
+    pipe = cache.cache._client.pipeline()
+    for server in servers:
+        pipe.hget('online_{}'.format(server), address)
+    online = []
+    for server, workers in zip(servers, pipe.execute()):
+        if workers:
+            online.extend([(worker, server) for worker in json.loads(workers)])
+    return online
+
+
+def online_addresses():
+    """ The set of addresses with a worker online on any server """
+    pipe = cache.cache._client.pipeline()
+    for server in xrange(len(current_app.config['monitor_addrs'])):
+        pipe.hkeys('online_{}'.format(server))
+    return set().union(*pipe.execute())
+
+
+def online_worker_count():
+    keys = ['online_count_{}'.format(server) for server
+            in xrange(len(current_app.config['monitor_addrs']))]
+    if not keys:
+        return 0
+    return sum([int(count) for count in cache.cache._client.mget(keys) if count])
+
+
+##############################################################################
+# HTTP caching helpers
+##############################################################################
+def stats_timestamps():
+    """ Grabs the cached values that the stats APIs are derived from. They
+    only change when new data is recorded (a new pool one minute slice, a
+    PPLNS recompute or a new network block) so they make a cheap validator
+    for conditional requests. """
+    keys = ['last_one_minute', 'pplns_cache_time', 'blockheight']
+    keys.extend(curr + '_blockheight' for curr in current_app.config['merged_cfg'])
+    vals = list(cache.get_many(*keys))
+    # if powerpool hasn't reported recently fall back to the current minute so
+    # clients still pick up changes once per slice
+    if vals[0] is None:
+        vals[0] = (int(time.time()) // 60) * 60
+    return vals
+
+
+def gzip_response(response):
+    """ Compresses a response body if the client accepts gzip and the body is
+    large enough to be worth it. """
+    min_size = current_app.config.get('gzip_min_size', 1024)
+    if (response.status_code != 200 or response.direct_passthrough or
+            'Content-Encoding' in response.headers or
+            'gzip' not in request.accept_encodings):
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+
+    buf = StringIO()
+    with gzip.GzipFile(mode='wb', compresslevel=6, fileobj=buf) as f:
+        f.write(data)
+    response.set_data(buf.getvalue())
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def compressed(func):
+    """ Decorator for JSON API views that can't be validated by
+    `conditional`, gzipping their responses without any caching headers. """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return gzip_response(make_response(func(*args, **kwargs)))
+    return wrapper
+
+
+def conditional(max_age=60):
+    """ Decorator for JSON API views. Sends an ETag and Last-Modified based on
+    `stats_timestamps` along with a Cache-Control header, and answers with a
+    304 without running the view if the client already has the latest
+    data. Only for pool wide data, an address's balances, shares and devices
+    change independently of those timestamps, so use `compressed` there. """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            vals = stats_timestamps()
+            etag = hashlib.sha1(request.full_path.encode('utf8') + repr(vals)).hexdigest()
+            last_modified = datetime.datetime.utcfromtimestamp(vals[0])
+            if isinstance(vals[1], datetime.datetime):
+                last_modified = max(last_modified, vals[1])
+
+            def add_headers(response):
+                response.set_etag(etag, weak=True)
+                response.last_modified = last_modified
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+                return response
+
+            if request.if_none_match:
+                fresh = request.if_none_match.contains_weak(etag)
+            else:
+                since = request.if_modified_since
+                fresh = since is not None and since >= last_modified.replace(microsecond=0)
+            if fresh:
+                return add_headers(current_app.response_class(status=304))
+
+            response = make_response(func(*args, **kwargs))
+            return gzip_response(add_headers(response))
+        return wrapper
+    return decorator
+
+
+##############################################################################
+# Live stats stream
+##############################################################################
+def publish_live(event, **data):
+    """ Publishes an event to the redis channel backing the live stats stream.
+    Failures are only logged, a missed live update shouldn't fail the task
+    that triggered it. """
+    channel = current_app.config.get('live_channel', 'live_stats')
+    try:
+        cache.cache._client.publish(channel, json.dumps(dict(event=event, data=data)))
+    except Exception:
+        current_app.logger.warn("Unable to publish {} live event".format(event),
+                                exc_info=True)
+
+
+def format_sse(event, data):
+    """ Formats a single Server-Sent Events message """
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
 ##############################################################################
 # Message validation and verification functions
 ##############################################################################
@@ -516,3 +896,60 @@ def resort_recent_visit(recent):
     total = float(sum([t[1] for t in session['recent_users']]))
     session['recent_users'] = [(addr, (visits / total))
                                for addr, visits in session['recent_users']]
+
+
+##############################################################################
+# Connection pool metrics
+##############################################################################
+# counted per process, since every gunicorn and celery worker has its own pools
+pool_counters = {'checkouts': 0, 'overflow_checkouts': 0, 'exhausted': 0}
+last_pool_log = [0]
+
+
+def watch_pool(engine):
+    """ Counts checkouts from the engine's pool, those that had to go beyond
+    the pool's fixed size, and those that left the pool exhausted so that the
+    next caller had to wait for a connection """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return
+
+    def checkout(dbapi_conn, conn_record, conn_proxy):
+        pool_counters['checkouts'] += 1
+        if pool.overflow() > 0:
+            pool_counters['overflow_checkouts'] += 1
+        if (pool._max_overflow > -1 and
+                pool.checkedout() >= pool.size() + pool._max_overflow):
+            pool_counters['exhausted'] += 1
+    event.listen(engine, 'checkout', checkout)
+
+
+def pool_stats():
+    stats = {'db_' + key: val for key, val in pool_counters.iteritems()}
+    pool = db.engine.pool
+    if isinstance(pool, QueuePool):
+        stats.update(db_size=pool.size(), db_checked_out=pool.checkedout(),
+                     db_overflow=max(pool.overflow(), 0))
+
+    rpool = cache.cache._client.connection_pool
+    if isinstance(rpool, redis.BlockingConnectionPool):
+        idle = len([c for c in list(rpool.pool.queue) if c is not None])
+        stats.update(redis_max=rpool.max_connections,
+                     redis_created=len(rpool._connections),
+                     redis_in_use=len(rpool._connections) - idle)
+    else:
+        stats.update(redis_created=rpool._created_connections,
+                     redis_in_use=len(rpool._in_use_connections))
+    return stats
+
+
+def log_pool_stats():
+    """ Logs this process's pool stats at most every pool_log_interval
+    seconds. Disabled if the interval isn't configured. """
+    interval = current_app.config.get('pool_log_interval')
+    if not interval or time.time() - last_pool_log[0] < interval:
+        return
+    last_pool_log[0] = time.time()
+    current_app.logger.info(
+        "Connection pools: " + " ".join("{}={}".format(key, val) for key, val
+                                        in sorted(pool_stats().iteritems())))
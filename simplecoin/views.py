@@ -1,11 +1,12 @@
 import calendar
-import time
-
+import csv
 import datetime
+import json
+import time
+from cStringIO import StringIO
 
-import yaml
 from flask import (current_app, request, render_template, Blueprint, abort,
-                   jsonify, g, session, Response)
+                   jsonify, session, Response, Markup, stream_with_context)
 from lever import get_joined
 
 from .models import (OneMinuteShare, Block, OneMinuteType, FiveMinuteType,
@@ -13,48 +14,87 @@ from .models import (OneMinuteShare, Block, OneMinuteType, FiveMinuteType,
                      FiveMinuteHashrate, OneMinuteHashrate, OneHourHashrate, OneMinuteTemperature,
                      FiveMinuteTemperature, OneHourTemperature, OneHourType,
                      MergeAddress)
-from . import db, root, cache
+from . import db, cache, content
 from .utils import (compress_typ, get_typ, verify_message, get_pool_acc_rej,
-                    get_pool_eff, last_10_shares, collect_user_stats, get_adj_round_shares,
-                    get_pool_hashrate, last_block_time, get_alerts,
+                    get_pool_eff, last_10_shares, collect_user_stats, pool_summary,
                     last_block_found, last_blockheight, resort_recent_visit,
-                    collect_acct_items, all_blocks, get_block_stats, CommandException)
+                    all_blocks, get_block_stats, CommandException,
+                    columnar_series, conditional, format_sse, keyset_page,
+                    acct_items_page, acct_item_cursor, iter_acct_history,
+                    acct_history_columns, log_pool_stats, read_replica,
+                    compressed)
 
 
 main = Blueprint('main', __name__)
 
 
+def render_news(news, limit=None):
+    return Markup(render_template('news_items.html', news=news[:limit]))
+
+
 @main.route("/")
 def home():
-    news = yaml.load(open(root + '/static/yaml/news.yaml'))
-    return render_template('home.html', news=news)
+    news_html = content.news.derived('home', lambda n: render_news(n, limit=3))
+    return render_template('home.html', news_html=news_html)
 
 
 @main.route("/news")
 def news():
-    news = yaml.load(open(root + '/static/yaml/news.yaml'))
-    return render_template('news.html', news=news)
+    news_html = content.news.derived('all', render_news)
+    return render_template('news.html', news_html=news_html)
+
+
+CURSOR_TIME = "%Y%m%d%H%M%S%f"
+
+
+def parse_cursor(name, *types):
+    """ Parses a pagination cursor of the form 'val_val' from the query
+    argument `name`, converting each part with the matching callable in
+    `types`. Missing or malformed cursors are treated as absent. """
+    raw = request.args.get(name)
+    if not raw:
+        return None
+    parts = raw.split('_', len(types) - 1)
+    if len(parts) != len(types):
+        return None
+    try:
+        return tuple(typ(part) for typ, part in zip(types, parts))
+    except ValueError:
+        return None
+
+
+def parse_time(val):
+    return datetime.datetime.strptime(val, CURSOR_TIME)
+
+
+def page_links(items, newer, older, cursor):
+    """ Builds the cursors for the newer and older page links from the first
+    and last item on the page. """
+    if not items:
+        return None, None
+    return (cursor(items[0]) if newer else None,
+            cursor(items[-1]) if older else None)
 
 
 @main.route("/blocks")
 @main.route("/blocks/<currency>")
+@read_replica
 def blocks(currency=None):
-    page = int(request.args.get('page', 0))
-    if page < 0:
-        page = 0
-    offset = page * 100
-    blocks = (db.session.query(Block).filter_by(merged_type=currency).
-              order_by(Block.height.desc()).offset(offset).limit(100))
-    return render_template('blocks.html', blocks=blocks, page=page)
+    query = db.session.query(Block).filter_by(merged_type=currency)
+    blocks, newer, older = keyset_page(query, [Block.height, Block.hash],
+                                       before=parse_cursor('before', int, str),
+                                       after=parse_cursor('after', int, str))
+    newer, older = page_links(blocks, newer, older,
+                              lambda b: "{}_{}".format(b.height, b.hash))
+    return render_template('blocks.html', blocks=blocks, newer=newer,
+                           older=older)
 
 
 @main.route("/<address>/account")
 @main.route("/<address>/account/<currency>")
+@read_replica
 def account(address, currency=None):
-    page = int(request.args.get('page', 0))
-    if page < 0:
-        page = 0
-    offset = page * 100
+    username = address
     if currency:
         addr = MergeAddress.query.filter_by(user=address, merged_type=currency).first()
         if not addr:
@@ -62,8 +102,64 @@ def account(address, currency=None):
         else:
             address = addr.merge_address
 
-    acct_items = collect_acct_items(address, limit=100, offset=offset, merged_type=currency)
-    return render_template('account.html', acct_items=acct_items, page=page)
+    acct_items, newer, older = acct_items_page(
+        address, 100, merged_type=currency,
+        before=parse_cursor('before', parse_time, int, str),
+        after=parse_cursor('after', parse_time, int, str))
+
+    def cursor(item):
+        created_at, item_id, typ = acct_item_cursor(item)
+        return "{}_{}_{}".format(created_at.strftime(CURSOR_TIME), item_id, typ)
+    newer, older = page_links(acct_items, newer, older, cursor)
+    return render_template('account.html', acct_items=acct_items,
+                           newer=newer, older=older, username=username,
+                           currency=currency)
+
+
+@main.route("/<address>/export/<any(csv, ndjson):fmt>")
+def account_export(address, fmt):
+    """ Streams the entire payout and bonus payout history of an address as
+    CSV or newline delimited JSON in a single response. """
+    currency = request.args.get('currency')
+    if currency:
+        addr = MergeAddress.query.filter_by(user=address, merged_type=currency).first()
+        if not addr:
+            abort(404)
+        address = addr.merge_address
+
+    rows = iter_acct_history(address, merged_type=currency)
+    if fmt == 'csv':
+        body = export_csv(rows)
+        mimetype = 'text/csv'
+    else:
+        body = export_ndjson(rows)
+        mimetype = 'application/x-ndjson'
+    filename = "{}_payouts.{}".format(address, fmt)
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=' + filename})
+
+
+def export_csv(rows, buffer_size=8192):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(acct_history_columns)
+    for row in rows:
+        row = list(row)
+        row[2] = row[2].isoformat()
+        writer.writerow(row)
+        # flush out reasonably sized pieces instead of a line at a time
+        if buf.tell() >= buffer_size:
+            yield buf.getvalue()
+            buf = StringIO()
+            writer = csv.writer(buf)
+    yield buf.getvalue()
+
+
+def export_ndjson(rows):
+    for row in rows:
+        item = dict(zip(acct_history_columns, row))
+        item['created_at'] = calendar.timegm(item['created_at'].utctimetuple())
+        yield json.dumps(item) + "\n"
 
 
 @main.route("/pool_stats")
@@ -83,7 +179,7 @@ def pool_stats():
                 filter_by(merged_type=cfg['currency_name']).
                 order_by(Block.height.desc()).limit(blocks_show))
         merged_blocks.append((cfg['currency_name'], cfg['name'], blks))
-    pool_luck, effective_return, orphan_perc = get_block_stats(g.average_difficulty)
+    pool_luck, effective_return, orphan_perc = get_block_stats(pool_summary().average_difficulty)
     reject_total, accept_total = get_pool_acc_rej()
     efficiency = get_pool_eff()
 
@@ -105,6 +201,7 @@ def network_stats():
 
 
 @main.route("/api/network_stats")
+@conditional()
 def network_stats_api():
     return jsonify(**network_data())
 
@@ -133,6 +230,8 @@ def network_data():
 
 
 @main.route("/network_stats/<graph_type>/<window>")
+@conditional()
+@read_replica
 def network_graph_data(graph_type=None, window="hour"):
     if not graph_type:
         return None
@@ -163,15 +262,26 @@ def network_graph_data(graph_type=None, window="hour"):
         types[m.typ].setdefault(stamp, 0)
         types[m.typ][stamp] += m.value
 
+    return graph_response(typ, types)
+
+
+def graph_response(typ, workers):
+    """ Serializes the {series: {timestamp: value}} map collected by one of
+    the graph endpoints. Clients can request `?format=columnar` to receive a
+    dense list of values per series instead, indexed from `start` by `step`
+    with nulls for the gaps. """
     step = typ.slice_seconds
     end = ((int(time.time()) // step) * step) - (step * 2)
     start = end - typ.window.total_seconds() + (step * 2)
 
-    return jsonify(start=start, end=end, step=step, workers=types)
+    if request.args.get('format') == 'columnar':
+        return jsonify(start=start, end=end, step=step, format='columnar',
+                       workers=columnar_series(workers, start, end, step))
+    return jsonify(start=start, end=end, step=step, workers=workers)
 
 
 @main.before_request
-def add_pool_stats():
+def fix_recent_users():
     try:
         try:
             if len(session['recent_users'][0]) != 2:
@@ -180,16 +290,19 @@ def add_pool_stats():
             pass
     except IndexError:
         pass
-    g.round_duration = (datetime.datetime.utcnow() - last_block_time()).total_seconds()
-    g.hashrate = get_pool_hashrate()
-    g.completed_block_shares = get_adj_round_shares(g.hashrate)
 
-    g.worker_count = cache.get('total_workers') or 0
-    g.average_difficulty = cache.get('difficulty_avg') or 1
-    g.shares_to_solve = g.average_difficulty * (2 ** 16)
-    g.last_n = current_app.config['last_n']
-    g.pplns_size = g.shares_to_solve * g.last_n
-    g.alerts = get_alerts()
+
+@main.after_app_request
+def report_pools(response):
+    log_pool_stats()
+    return response
+
+
+@main.context_processor
+def add_pool_stats():
+    """ Exposes the pool summary to templates. It's only assembled if the
+    template actually uses it. """
+    return dict(pool=pool_summary())
 
 
 @main.route("/close/<int:id>")
@@ -201,26 +314,66 @@ def close_alert(id):
 
 
 @main.route("/api/pool_stats")
+@conditional()
 def pool_stats_api():
+    pool = pool_summary()
     ret = {}
-    ret['hashrate'] = get_pool_hashrate()
-    ret['workers'] = g.worker_count
-    ret['completed_shares'] = g.completed_block_shares
-    ret['total_round_shares'] = g.pplns_size
-    ret['round_duration'] = g.round_duration
-    sps = float(g.completed_block_shares) / g.round_duration
+    ret['hashrate'] = pool.hashrate
+    ret['workers'] = pool.worker_count
+    ret['completed_shares'] = pool.completed_block_shares
+    ret['total_round_shares'] = pool.pplns_size
+    ret['round_duration'] = pool.round_duration
+    sps = float(pool.completed_block_shares) / pool.round_duration
     ret['shares_per_sec'] = sps
     ret['last_block_found'] = last_blockheight()
-    ret['shares_to_solve'] = g.shares_to_solve
+    ret['shares_to_solve'] = pool.shares_to_solve
     if sps > 0:
-        ret['est_sec_remaining'] = (float(g.shares_to_solve) - g.completed_block_shares) / sps
+        ret['est_sec_remaining'] = (float(pool.shares_to_solve) - pool.completed_block_shares) / sps
     else:
         ret['est_sec_remaining'] = 'infinite'
-    ret['pool_luck'], ret['effective_return'], ret['orphan_perc'] = get_block_stats(g.average_difficulty)
+    ret['pool_luck'], ret['effective_return'], ret['orphan_perc'] = get_block_stats(pool.average_difficulty)
     return jsonify(**ret)
 
 
+@main.route("/api/live")
+def live_stats():
+    """ Server-Sent Events stream of pool stats. Sends the current values on
+    connect, then relays the events that the celery tasks publish as the
+    hashrate, round shares, worker count and network change or a block is
+    found. Each open stream holds a worker for as long as the page is open,
+    so it's only served when live_stream is enabled, which needs async
+    workers in front of it. """
+    if not current_app.config.get('live_stream', False):
+        abort(404)
+
+    pubsub = cache.cache._client.pubsub()
+    pubsub.subscribe(current_app.config.get('live_channel', 'live_stats'))
+    pool = pool_summary()
+    snapshot = [('pool', dict(hashrate=pool.hashrate,
+                              round_shares=pool.completed_block_shares)),
+                ('workers', dict(workers=pool.worker_count))]
+
+    def stream():
+        try:
+            # ask the browser to wait a bit before reconnecting after a drop
+            yield "retry: 10000\n\n"
+            for event, data in snapshot:
+                yield format_sse(event, data)
+            for msg in pubsub.listen():
+                if msg['type'] != 'message':
+                    continue
+                payload = json.loads(msg['data'])
+                yield format_sse(payload['event'], payload['data'])
+        finally:
+            pubsub.reset()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 @main.route("/api/last_block")
+@conditional()
 def last_block_api():
     b = last_block_found()
     if not b:
@@ -240,20 +393,21 @@ def mpos_pool_stats_api():
     action = request.args.get('action', 'none')
     api_key = request.args.get('api_key', 'none')
     if (action == 'getpoolstatus') & (api_key in current_app.config['mpos_api_keys']):
-        sps = float(g.completed_block_shares) / g.round_duration
+        pool = pool_summary()
+        sps = float(pool.completed_block_shares) / pool.round_duration
         difficulty = cache.get('difficulty') or 0
         blockheight = cache.get('blockheight') or 0
         data = {"pool_name": current_app.config['site_url'],
-                "hashrate": round(get_pool_hashrate(), 0),
+                "hashrate": round(pool.hashrate, 0),
                 "efficiency": round(get_pool_eff(), 2),
-                "workers": g.worker_count,
+                "workers": pool.worker_count,
                 "currentnetworkblock": blockheight,
                 "nextnetworkblock": blockheight+1,
                 "lastblock": last_blockheight(),
                 "networkdiff": difficulty,
-                "esttime": round((float(g.shares_to_solve) - g.completed_block_shares) / sps, 0),
-                "estshares": round(g.shares_to_solve, 0),
-                "timesincelast": round(g.round_duration, 0),
+                "esttime": round((float(pool.shares_to_solve) - pool.completed_block_shares) / sps, 0),
+                "estshares": round(pool.shares_to_solve, 0),
+                "timesincelast": round(pool.round_duration, 0),
                 "nethashrate": round((difficulty * 2**32) / current_app.config['block_time'], 0)
                 }
         ret['getpoolstatus'] = {"version": "0.3", "runtime": 0, "data": data}
@@ -335,6 +489,8 @@ def worker_detail(address, worker):
 
 
 @main.route("/<address>/<worker>/<stat_type>/<window>")
+@compressed
+@read_replica
 def worker_stats(address=None, worker=None, stat_type=None, window="hour"):
 
     if not address or not worker or not stat_type:
@@ -371,11 +527,8 @@ def worker_stats(address=None, worker=None, stat_type=None, window="hour"):
             workers.setdefault(m.worker, {})
             workers[m.worker].setdefault(stamp, 0)
             workers[m.worker][stamp] += m.value
-    step = typ.slice_seconds
-    end = ((int(time.time()) // step) * step) - (step * 2)
-    start = end - typ.window.total_seconds() + (step * 2)
 
-    return jsonify(start=start, end=end, step=step, workers=workers)
+    return graph_response(typ, workers)
 
 
 @main.route("/<address>")
@@ -395,6 +548,7 @@ def user_dashboard(address=None):
 
 
 @main.route("/api/<address>")
+@compressed
 def address_api(address):
     if len(address) != 34:
         abort(404)
@@ -413,12 +567,13 @@ def address_api(address):
     stats['total_earned'] = float(stats['total_earned'])
     if stats['pplns_cached_time']:
         stats['pplns_cached_time'] = calendar.timegm(stats['pplns_cached_time'].utctimetuple())
+    pool = pool_summary()
     day_shares = stats['last_10_shares'] * 6 * 24
-    daily_percentage = float(day_shares) / g.shares_to_solve
+    daily_percentage = float(day_shares) / pool.shares_to_solve
     donation_perc = (1 - (stats['donation_perc'] / 100.0))
     rrwd = current_app.config['reward']
     stats['daily_est'] = daily_percentage * rrwd * donation_perc
-    stats['est_round_payout'] = (float(stats['round_shares']) / g.pplns_size) * donation_perc * rrwd
+    stats['est_round_payout'] = (float(stats['round_shares']) / pool.pplns_size) * donation_perc * rrwd
     return jsonify(**stats)
 
 
@@ -437,6 +592,8 @@ def address_clear(address=None):
 
 @main.route("/<address>/stats")
 @main.route("/<address>/stats/<window>")
+@compressed
+@read_replica
 def address_stats(address=None, window="hour"):
     # store all the raw data of we've grabbed
     workers = {}
@@ -455,15 +612,12 @@ def address_stats(address=None, window="hour"):
         workers.setdefault(m.worker, {})
         workers[m.worker].setdefault(stamp, 0)
         workers[m.worker][stamp] += m.value
-    step = typ.slice_seconds
-    end = ((int(time.time()) // step) * step) - (step * 2)
-    start = end - typ.window.total_seconds() + (step * 2)
 
     if address == "pool" and '' in workers:
         workers['Entire Pool'] = workers['']
         del workers['']
 
-    return jsonify(start=start, end=end, step=step, workers=workers)
+    return graph_response(typ, workers)
 
 
 @main.errorhandler(Exception)
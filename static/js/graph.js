@@ -56,20 +56,22 @@ generate_graph = function(request_url, date_format, user) {
   var last_10min = 0;
   generate_data = function(request_url, date_format, user) {
     clean_data = [];
-    d3.json('/' + user + '/stats/' + request_url, function(data) {
+    d3.json('/' + user + '/stats/' + request_url + '?format=columnar', function(data) {
       start = data.start;
       end = data.end;
       step = data.step;
       for (var key in data.workers) {
         var worker = data.workers[key];
         var values = []
-        for (var i = start; i <= end; i += step) {
+        //Columnar format, one value per step starting at start. Gaps are null
+        for (var j = 0; j < worker.length; j++) {
+          var i = start + (j * step);
 
-          if (i in worker) {
-            values.push([i * 1000, worker[i]]);
+          if (worker[j] !== null) {
+            values.push([i * 1000, worker[j]]);
             //If this is an hour loop build a total value for last 10min
             if (i > (end - (10 * step)) &&  request_url == 'hour') {
-              last_10min += worker[i];
+              last_10min += worker[j];
             }
           } else {
             values.push([i * 1000, 0]);
@@ -132,7 +134,7 @@ generate_worker_graph = function(target, request_url, date_format, user, worker,
   var clean_data = [];
   generate_worker_data = function(target, request_url, date_format, user, worker, stat_type) {
     clean_data = [];
-    d3.json('/' + user + '/' + worker + '/' + stat_type + '/' + request_url, function(data) {
+    d3.json('/' + user + '/' + worker + '/' + stat_type + '/' + request_url + '?format=columnar', function(data) {
 
       start = data.start;
       end = data.end;
@@ -142,11 +144,12 @@ generate_worker_graph = function(target, request_url, date_format, user, worker,
         var worker = data.workers[key];
         var values = [];
 
-        for (var i = start; i <= end; i += step) {
-          if (i in worker) {
-            if (worker[i] < 0){ worker[i] = 0; }
-            values.push([i * 1000, worker[i]]);
-            values_no_stamp.push(worker[i]);
+        for (var j = 0; j < worker.length; j++) {
+          var i = start + (j * step);
+          if (worker[j] !== null) {
+            if (worker[j] < 0){ worker[j] = 0; }
+            values.push([i * 1000, worker[j]]);
+            values_no_stamp.push(worker[j]);
           } else {
             values.push([i * 1000, 0]);
           }
@@ -224,7 +227,7 @@ generate_network_graph = function(target, request_url, date_format, graph_type,
   var clean_data = [];
   generate_network_data = function(target, request_url, date_format, graph_type, network_block_time) {
     clean_data = [];
-    d3.json('/network_stats/' + graph_type + '/' + request_url, function(data) {
+    d3.json('/network_stats/' + graph_type + '/' + request_url + '?format=columnar', function(data) {
 
       start = data.start;
       end = data.end;
@@ -234,9 +237,11 @@ generate_network_graph = function(target, request_url, date_format, graph_type,
         var worker = data.workers[key];
         var values = [];
 
-        var x;
-        for (x in worker) {
-          values.push([x * 1000, worker[x]/1000]);
+        //Only plot the slices that actually have a value
+        for (var j = 0; j < worker.length; j++) {
+          if (worker[j] !== null) {
+            values.push([(start + (j * step)) * 1000, worker[j]/1000]);
+          }
         }
 
         if (key == "")